@@ -66,6 +66,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'store.context_processors.cart',
             ],
         },
     },
@@ -91,6 +92,15 @@ DATABASES = {
     }
 }
 
+# Кэш общий для веб-процессов и задач Celery: версии каталога, дерево,
+# фрагменты и страницы должны меняться во всех процессах сразу
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.getenv('MEMCACHED_LOCATION', '127.0.0.1:11211'),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -159,3 +169,6 @@ CELERY_TIMEZONE = 'Asia/Novosibirsk'
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# Токен кассы для передачи остатков: заголовок Authorization: Token <token>
+POS_API_TOKEN = os.getenv('POS_API_TOKEN')
+
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.contrib.auth.views import LogoutView
 from django.conf import settings
 from django.conf.urls.static import static
@@ -15,6 +15,7 @@ from store.views import (
     EmailView,
     WelcomeView,
     EmailConfirmationView,
+    MediaView,
 )
 
 
@@ -54,6 +55,13 @@ urlpatterns = [
     path('gitwebhook/', include('git_hook.urls')),
 ]
 
-# nginx сам пересылает /static и /media, эти директивы нужны для tor hidden services
+# nginx сам пересылает /static и /media, эти директивы нужны для tor hidden services.
+# Производные изображений названы по содержимому, в nginx для них:
+#   location ~ ^/media/(big|card|thumb)/[0-9a-f]{32}\.(jpg|webp)$ {
+#       add_header Cache-Control "public, max-age=31536000, immutable";
+#   }
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+if settings.DEBUG:
+    urlpatterns += [
+        re_path(r'^media/(?P<path>.*)$', MediaView.as_view(), name='media'),
+    ]
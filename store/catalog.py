@@ -0,0 +1,77 @@
+import hashlib
+
+from django.core.cache import cache
+from django.urls import reverse
+
+from store.models import Group, Category, PublishedProduct
+from store.utils import catalog_version, scope_versions, query_terms
+
+CATALOG_TREE_TIMEOUT = 24 * 60 * 60
+# Найденных товаров не больше, широкий запрос не выводит весь каталог
+SEARCH_LIMIT = 1000
+SEARCH_TIMEOUT = 60 * 60
+
+
+def build_catalog_tree():
+    """Groups with their categories: names, urls and product counts."""
+    fields = ('id', 'name', 'product_count', 'in_stock_count')
+    groups = {}
+    for group in Group.objects.order_by('name').values(*fields):
+        group['url'] = reverse('group_detail', kwargs={'pk': group['id']})
+        group['categories'] = []
+        groups[group['id']] = group
+
+    categories = {}
+    for category in Category.objects.order_by('name').values(
+            'parent_id', *fields):
+        category['url'] = reverse('category_detail',
+                                  kwargs={'pk': category['id']})
+        category['group'] = groups.get(category.pop('parent_id'))
+        if category['group']:
+            category['group']['categories'].append(category)
+        categories[category['id']] = category
+
+    return {
+        'groups': list(groups.values()),
+        'group_by_id': groups,
+        'categories': categories,
+    }
+
+
+def get_catalog_tree():
+    """
+    The catalog tree, built once per version of group and category names
+    and of their counts, see store.utils.scope_versions.
+    """
+    versions = scope_versions(['tree', 'counts'])
+    key = f'catalog:tree:{versions["tree"]}:{versions["counts"]}'
+    tree = cache.get(key)
+    if tree is None:
+        tree = build_catalog_tree()
+        cache.set(key, tree, CATALOG_TREE_TIMEOUT)
+    return tree
+
+
+def search_product_ids(query):
+    """
+    Ids of the products found by query, best first, at most SEARCH_LIMIT.
+    Queries with the same terms ('Кабеля медные', 'медный кабель') share
+    the result, cached until the catalog version changes.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return []
+    normalized = ' '.join(sorted(terms))
+    key = f'search:{catalog_version()}:' \
+          f'{hashlib.md5(normalized.encode()).hexdigest()}'
+    ids = cache.get(key)
+    if ids is None:
+        ids = list(PublishedProduct.objects.search(terms)
+                   .values_list('id', flat=True)[:SEARCH_LIMIT])
+        # Похоже на артикул: сначала товары с этим артикулом
+        if any(char.isdigit() for char in query):
+            articles = PublishedProduct.objects.find_article(query)
+            ids = (articles + [pk for pk in ids
+                               if pk not in articles])[:SEARCH_LIMIT]
+        cache.set(key, ids, SEARCH_TIMEOUT)
+    return ids
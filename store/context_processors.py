@@ -0,0 +1,14 @@
+from django.utils.functional import SimpleLazyObject
+
+from .mixins import get_cart_summary
+
+
+def cart(request):
+    """
+    Cart badge of base.html from the cached cart summary, read only when
+    the template shows it. Pages of PageCacheMixin load it by script.
+    """
+    if getattr(request, 'page_cache', False):
+        return {}
+    session = request.COOKIES.get('customersession')
+    return {'cart': SimpleLazyObject(lambda: get_cart_summary(session))}
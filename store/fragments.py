@@ -0,0 +1,43 @@
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from store.utils import scope_versions, bump_scope_versions
+
+FRAGMENT_TEMPLATES = {
+    'card': 'item_card.html',
+    'row': 'item_row.html',
+}
+FRAGMENT_TIMEOUT = 24 * 60 * 60
+
+
+def invalidate_products(ids):
+    """Bump versions of the changed products, their fragments expire."""
+    bump_scope_versions([f'product:{pk}' for pk in ids])
+
+
+def render_products(products, variant):
+    """
+    Html of item_card.html ('card') or item_row.html ('row') per product.
+    Fragments are cached by product id and version: two cache requests
+    per page, only new and changed products are rendered.
+    """
+    products = list(products)
+    scopes = {product.pk: f'product:{product.pk}' for product in products}
+    versions = scope_versions(scopes.values())
+    keys = {
+        pk: f'fragment:{variant}:{pk}:{versions[scope]}'
+        for pk, scope in scopes.items()
+    }
+    cached = cache.get_many(keys.values())
+
+    html, rendered = [], {}
+    for product in products:
+        key = keys[product.pk]
+        if key not in cached:
+            rendered[key] = cached[key] = render_to_string(
+                FRAGMENT_TEMPLATES[variant], {'product': product})
+        html.append(mark_safe(cached[key]))
+    if rendered:
+        cache.set_many(rendered, FRAGMENT_TIMEOUT)
+    return html
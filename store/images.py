@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor, \
+    TimeoutError as FutureTimeoutError
+
+from PIL import Image
+
+from electron.settings import MEDIA_ROOT
+from store.utils import get_redis, RELEASE_LOCK_SCRIPT
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+
+# Производные с именем по содержимому никогда не меняются
+IMMUTABLE_NAME = re.compile(
+    r'^(?:(?:big|card|thumb)/[0-9a-f]{32}|img/[0-9a-f]{32}/\d+x\d+)'
+    r'\.(?:jpg|webp)$'
+)
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Размеры (ширина, высота), которые можно запросить у /img/
+VARIANT_SIZES = {
+    (50, 50), (100, 100),
+    (300, 400), (600, 800),
+    (1100, 3000),
+}
+VARIANT_FORMATS = {'jpg': ('JPEG', 85), 'webp': ('WEBP', 80)}
+# Сколько ждать варианта, который строит другой процесс
+VARIANT_TIMEOUT = 30
+# Процессов на сервер для построения вариантов
+RESIZE_WORKERS = 2
+
+_resize_pool = None
+
+
+def content_hash(file):
+    """Hash of an uploaded file or a file on disk."""
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    else:
+        file.seek(0)
+        for block in file.chunks():
+            digest.update(block)
+        file.seek(0)
+    return digest.hexdigest()
+
+
+def media_path(name):
+    return os.path.join(MEDIA_ROOT, name)
+
+
+def derivative_name(directory, image_hash, image_format):
+    # Имя по содержимому: при смене изображения меняется и адрес, поэтому
+    # файл по этому адресу можно кэшировать навсегда
+    return os.path.join(directory, f'{image_hash}.{EXTENSIONS[image_format]}')
+
+
+def make_derivatives(source, image_hash, derivatives, formats):
+    """
+    Write resized copies of the source image for every
+    (directory, size, quality) of derivatives in every format, largest
+    first. Returns names relative to MEDIA_ROOT.
+    """
+    names = []
+    with Image.open(source) as img:
+        img.load()
+        img = img.convert('RGB')
+
+    for directory, size, quality in derivatives:
+        img.thumbnail(size, Image.LANCZOS)
+        for image_format in formats:
+            name = derivative_name(directory, image_hash, image_format)
+            path = media_path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            img.save(path, image_format, quality=quality)
+            names.append(name)
+    return names
+
+
+def delete_image_files(name, image_hash, derivatives, formats):
+    """Delete the original, all derivatives and variants of an image."""
+    names = [name] + [
+        derivative_name(directory, image_hash, image_format)
+        for directory, _, _ in derivatives for image_format in formats
+    ]
+    for name in names:
+        if os.path.exists(media_path(name)):
+            os.remove(media_path(name))
+    shutil.rmtree(media_path(variant_dir(image_hash)), ignore_errors=True)
+
+
+def variant_dir(image_hash):
+    return os.path.join('img', image_hash)
+
+
+def variant_name(image_hash, width, height, ext):
+    return os.path.join(variant_dir(image_hash), f'{width}x{height}.{ext}')
+
+
+def make_variant(source, path, size, image_format, quality):
+    """Runs in the resize pool. The file appears only when fully written."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with Image.open(source) as img:
+        img.load()
+        img = img.convert('RGB')
+    img.thumbnail(size, Image.LANCZOS)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        img.save(tmp, image_format, quality=quality)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def resize_pool():
+    global _resize_pool
+    if _resize_pool is None:
+        _resize_pool = ProcessPoolExecutor(max_workers=RESIZE_WORKERS)
+    return _resize_pool
+
+
+def get_variant(source, name, size, ext):
+    """
+    Make sure the variant is on disk. It is generated once in the cluster:
+    the process holding the lock resizes, the others wait for the file.
+    Returns False if it did not appear within VARIANT_TIMEOUT or the
+    original can not be read.
+    """
+    path = media_path(name)
+    if os.path.exists(path):
+        return True
+
+    r = get_redis()
+    key, token = f'store:img:{name}', uuid.uuid4().hex
+    if r.set(key, token, nx=True, ex=VARIANT_TIMEOUT):
+        try:
+            if not os.path.exists(path):
+                image_format, quality = VARIANT_FORMATS[ext]
+                resize_pool().submit(
+                    make_variant, source, path, size, image_format, quality
+                ).result(timeout=VARIANT_TIMEOUT)
+        except (FutureTimeoutError, BrokenExecutor, OSError,
+                Image.DecompressionBombError) as e:
+            # OSError - в том числе нечитаемый или поврежденный оригинал
+            logger.warning('Variant %s failed: %r', name, e)
+            return False
+        finally:
+            r.eval(RELEASE_LOCK_SCRIPT, 1, key, token)
+        return True
+
+    deadline = time.monotonic() + VARIANT_TIMEOUT
+    while time.monotonic() < deadline:
+        if os.path.exists(path):
+            return True
+        time.sleep(0.05)
+    return False
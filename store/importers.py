@@ -0,0 +1,437 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from decimal import Decimal, InvalidOperation
+from xml.etree import ElementTree as ET
+
+from django.db import transaction
+
+from store.models import Category, Product, PublishedProduct
+from store.signals import products_changed
+from store.utils import bump_catalog_version
+
+logger = logging.getLogger(__name__)
+
+# Количество объектов в одном bulk-запросе и строк в одной транзакции
+BATCH_SIZE = 500
+CHUNK_SIZE = 5000
+
+PRICE_QUANT = Decimal('0.01')
+
+
+def chunked(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class ImportManifest:
+    """
+    Fingerprints of the last successful import of a file: the hash of the
+    whole file and a short hash of every row keyed by its id. Stored as
+    json next to the imported file.
+    """
+
+    def __init__(self, file):
+        self.path = f'{file}.manifest'
+        self.file_hash = None
+        self.rows = {}
+        self.new_rows = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            self.file_hash, self.rows = data['file'], data['rows']
+
+    @staticmethod
+    def hash_file(file):
+        digest = hashlib.blake2b()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def hash_row(row):
+        return hashlib.blake2b('\x1f'.join(row).encode(),
+                               digest_size=8).hexdigest()
+
+    def is_changed(self, key, row):
+        digest = self.hash_row(row)
+        self.new_rows[str(key)] = digest
+        return self.rows.get(str(key)) != digest
+
+    def discard(self, key):
+        """Forget a row that was not written, so it is retried next time."""
+        self.new_rows.pop(str(key), None)
+
+    @staticmethod
+    def dump(path, data):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def save(self, file_hash, pending=False):
+        """
+        Save the fingerprints of this import. A pending manifest is used
+        when rows are written by other processes, see commit().
+        """
+        self.file_hash, self.rows = file_hash, self.new_rows
+        path = f'{self.path}.pending' if pending else self.path
+        self.dump(path, {'file': self.file_hash, 'rows': self.rows})
+
+    def commit(self, discard=()):
+        """Promote the pending manifest, forgetting rows that failed."""
+        pending = f'{self.path}.pending'
+        with open(pending) as f:
+            data = json.load(f)
+        for key in discard:
+            data['rows'].pop(str(key), None)
+        self.dump(self.path, data)
+        os.remove(pending)
+
+    def rollback(self):
+        """Drop the pending manifest of a failed import."""
+        pending = f'{self.path}.pending'
+        if os.path.exists(pending):
+            os.remove(pending)
+
+
+class BaseImporter:
+    summary_keys = ()
+
+    def __init__(self, chunk_size=CHUNK_SIZE, batch_size=BATCH_SIZE,
+                 use_manifest=True, category_model=Category,
+                 product_model=Product, notify=True):
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.use_manifest = use_manifest
+        # Без notify run не трогает витрину и кэши, см. import_benchmark
+        self.notify_changes = notify
+        # Импорт может писать в промежуточные таблицы, см. store.staging
+        self.category_model = category_model
+        self.product_model = product_model
+        self.manifest = None
+        self.file_hash = None
+        self.summary = Counter(dict.fromkeys(self.summary_keys, 0))
+        self.changed_products = set()
+        # Категории, в которые товары пришли и из которых ушли
+        self.changed_categories = set()
+        # Созданы или переименованы категории
+        self.categories_written = False
+        self.bad_keys = set()
+        self.timings = Counter()
+
+    @contextmanager
+    def phase(self, name):
+        """Accumulate wall time of an import phase: parse, lookup, write."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - started
+
+    def file_unchanged(self, file):
+        """Check the file against the manifest of the previous import."""
+        if not self.use_manifest:
+            return False
+        self.manifest = ImportManifest(file)
+        self.file_hash = self.manifest.hash_file(file)
+        if self.manifest.file_hash == self.file_hash:
+            logger.info('%s is unchanged since the last import', file)
+            return True
+        return False
+
+    def save_manifest(self, pending=False):
+        if self.manifest:
+            for key in self.bad_keys:
+                self.manifest.discard(key)
+            self.manifest.save(self.file_hash, pending=pending)
+
+    def notify(self):
+        """Send products_changed for the products written to the catalog."""
+        if self.categories_written and self.category_model is Category:
+            PublishedProduct.objects.refresh_names()
+            bump_catalog_version(['tree'])
+        if self.changed_products and self.product_model is Product:
+            products_changed.send(
+                sender=Product, ids=set(self.changed_products),
+                categories=set(self.changed_categories) or None,
+            )
+
+    def bulk_create(self, model, objects):
+        for chunk in chunked(objects, self.chunk_size):
+            with transaction.atomic():
+                model.objects.bulk_create(chunk, batch_size=self.batch_size)
+
+    def bulk_update(self, model, objects, fields):
+        for chunk in chunked(objects, self.chunk_size):
+            with transaction.atomic():
+                model.objects.bulk_update(chunk, fields,
+                                          batch_size=self.batch_size)
+
+
+class AtolImporter(BaseImporter):
+    """
+    Import categories and products from the ATOL csv export.
+
+    Existing ids are loaded once, every row is compared with them and only
+    new or changed objects are written with bulk_create / bulk_update,
+    one transaction per chunk. Categories are written before products so
+    that a product may reference a category defined anywhere in the file.
+    Rows identical to the previous import (see ImportManifest) are not
+    parsed at all.
+    """
+    summary_keys = ('created', 'updated', 'skipped', 'bad')
+    product_fields = ('category', 'article', 'title', 'price')
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.categories = {}
+        self.products = {}
+
+    def read(self, file):
+        with open(file, 'r') as f:
+            yield from csv.reader(f, delimiter=';')
+
+    @staticmethod
+    def is_category(row):
+        return len(row) > 55 and len(row[25]) == 0 and len(row[4]) == 0
+
+    def select(self, rows):
+        """Drop incomplete rows and rows unchanged since the last import."""
+        for row in rows:
+            if len(row) < 25:  # строка содержит меньше 25  полей - игнорируем
+                self.summary['skipped'] += 1
+            elif self.manifest and not self.manifest.is_changed(row[0], row):
+                self.summary['skipped'] += 1
+            else:
+                yield row
+
+    def parse(self, rows):
+        """Split rows into {id: name} categories and {id: values} products."""
+        categories, products = {}, {}
+
+        for row in rows:
+            try:
+                key = int(row[0])
+                article = row[25]
+                price = row[4]
+                # Удаляем круглые скобки в начале Наименования
+                name = re.sub(r'^\([^)]+\)\s*', '', row[2])
+
+                if len(name) < 2:  # Длина наименования меньше 2 - игнорируем
+                    self.summary['skipped'] += 1
+                    continue
+                if self.is_category(row):
+                    categories[key] = name
+                else:
+                    price = Decimal(price.replace(',', '.')).quantize(PRICE_QUANT)
+                    products[key] = (int(row[15]), article, name, price)
+
+            except (IndexError, ValueError, InvalidOperation) as e:
+                self.summary['bad'] += 1
+                logger.warning('Bad row %s: %s', row, e)
+                self.bad_keys.add(row[0])
+
+        return categories, products
+
+    def load(self, product_ids=None):
+        """
+        Load ids and comparable values of the whole catalog at once, or of
+        the given products only.
+        """
+        # order_by(): сортировка модели добавила бы JOIN категорий и групп
+        self.categories = dict(
+            self.category_model.objects.order_by().values_list('id', 'name')
+        )
+
+        products = self.product_model.objects.order_by().values_list(
+            'id', 'category_id', 'article', 'title', 'price'
+        )
+        if product_ids is None:
+            querysets = [products.iterator()]
+        else:
+            querysets = [products.filter(id__in=ids) for ids
+                         in chunked(product_ids, self.batch_size)]
+
+        self.products = {
+            pk: (category_id, article, title, price.quantize(PRICE_QUANT))
+            for queryset in querysets
+            for pk, category_id, article, title, price in queryset
+        }
+
+    def write_categories(self, categories):
+        new, changed = [], []
+        for pk, name in categories.items():
+            category = self.category_model(id=pk, name=name)
+            if pk not in self.categories:
+                new.append(category)
+            elif self.categories[pk] != name:
+                changed.append(category)
+            else:
+                self.summary['skipped'] += 1
+            self.categories[pk] = name
+
+        self.bulk_create(self.category_model, new)
+        self.bulk_update(self.category_model, changed, ['name'])
+        self.categories_written = bool(new or changed)
+
+        self.summary['created'] += len(new)
+        self.summary['updated'] += len(changed)
+
+    def write_products(self, products):
+        new, changed = [], []
+        for pk, values in products.items():
+            category_id, article, title, price = values
+            if category_id not in self.categories:
+                self.summary['bad'] += 1
+                logger.warning('Product %s: category %s not found',
+                               pk, category_id)
+                self.bad_keys.add(str(pk))
+                continue
+
+            product = self.product_model(id=pk, category_id=category_id,
+                                         article=article, title=title,
+                                         price=price)
+            if pk not in self.products:
+                new.append(product)
+            elif self.products[pk] != values:
+                changed.append(product)
+                self.changed_categories.add(self.products[pk][0])
+            else:
+                self.summary['skipped'] += 1
+                continue
+            self.products[pk] = values
+            self.changed_products.add(pk)
+            self.changed_categories.add(category_id)
+
+        self.bulk_create(self.product_model, new)
+        self.bulk_update(self.product_model, changed, self.product_fields)
+
+        self.summary['created'] += len(new)
+        self.summary['updated'] += len(changed)
+
+    def run(self, file):
+        if self.file_unchanged(file):
+            return dict(self.summary)
+        with self.phase('parse'):
+            categories, products = self.parse(self.select(self.read(file)))
+        with self.phase('lookup'):
+            self.load()
+        with self.phase('write'):
+            self.write_categories(categories)
+            self.write_products(products)
+        self.save_manifest()
+        if self.notify_changes:
+            self.notify()
+        logger.info('ATOL import %s: %s', file, dict(self.summary))
+        return dict(self.summary)
+
+
+class StockImporter(BaseImporter):
+    """
+    Streaming import of warehouse counts from export.xml:
+
+        <?xml version="1.0" encoding="windows-1251" ?>
+        <items date="22.02.21">
+        <nom id="36291" name="AUTO MOBIL Очиститель двигателя, 440мл 3-028" art="01013">
+            <prices>
+                <price  name="Розничная" value="113"/>
+            </prices>
+            <whs>
+                <scl name="ЭЛЕКТРОН  ул. Ленина, 28" count="0" />
+                <scl name="Магазин-склад ЭЛЕКТРИКА" count="3" />
+            </whs>
+        </nom>
+        ...
+        </items>
+
+    Parsed <nom> nodes are dropped as soon as they are read, so memory does
+    not depend on the file size. Only products whose counts differ from the
+    database are written.
+    """
+    summary_keys = ('updated', 'skipped', 'missing', 'bad')
+    stock_fields = ('warehouse1', 'warehouse2')
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.stock = {}
+
+    def parse(self, file):
+        """Yield (id, warehouse1, warehouse2) for every <nom> node."""
+        context = ET.iterparse(file, events=('start', 'end'))
+        _, root = next(context)
+
+        for event, node in context:
+            if event != 'end' or node.tag != 'nom':
+                continue
+            try:
+                whs = [int(scl.get('count')) for scl in node.findall('whs/scl')]
+                item = int(node.get('id')), whs[0], whs[1]
+            except (IndexError, TypeError, ValueError) as e:
+                self.summary['bad'] += 1
+                logger.warning('Bad node id=%s name=%s: %s',
+                               node.get('id'), node.get('name'), e)
+            else:
+                yield item
+            root.clear()
+
+    def load(self):
+        self.stock = {
+            pk: (w1, w2) for pk, w1, w2
+            in self.product_model.objects.order_by().values_list(
+                'id', *self.stock_fields
+            ).iterator()
+        }
+
+    def write(self, changed):
+        with self.phase('write'):
+            self.bulk_update(self.product_model, changed, self.stock_fields)
+        self.summary['updated'] += len(changed)
+
+    def run(self, file):
+        # Построчные отпечатки здесь не нужны: сравнение с загруженными
+        # остатками и есть построчная дельта, к тому же остатки меняются
+        # не только импортом
+        if self.file_unchanged(file):
+            return dict(self.summary)
+        with self.phase('lookup'):
+            self.load()
+        changed = []
+
+        # Разбор файла идет вперемешку с записью, время записи вычитается
+        started = time.perf_counter()
+        for pk, w1, w2 in self.parse(file):
+            if pk not in self.stock:
+                # Товары, которых не оказалось в atol файле (без категорий)
+                # отбрасываются
+                self.summary['missing'] += 1
+                continue
+            if self.stock[pk] == (w1, w2):
+                self.summary['skipped'] += 1
+                continue
+
+            self.stock[pk] = (w1, w2)
+            self.changed_products.add(pk)
+            changed.append(
+                self.product_model(id=pk, warehouse1=w1, warehouse2=w2)
+            )
+            if len(changed) >= self.chunk_size:
+                self.write(changed)
+                changed = []
+
+        self.write(changed)
+        self.timings['parse'] += \
+            time.perf_counter() - started - self.timings['write']
+        self.save_manifest()
+        if self.notify_changes:
+            self.notify()
+        logger.info('Stock import %s: %s', file, dict(self.summary))
+        return dict(self.summary)
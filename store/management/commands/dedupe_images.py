@@ -0,0 +1,111 @@
+import os
+import shutil
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.images import content_hash, make_derivatives, media_path, \
+    derivative_name
+from store.importers import BATCH_SIZE
+from store.management.commands.import_images import IMAGE_EXTENSIONS
+from store.models import Product, ProductImage
+from store.signals import products_changed
+
+
+class Command(BaseCommand):
+    help = 'Store product images once per content: move originals to ' \
+           '<hash>.<ext>, rebuild reference counts and delete files no ' \
+           'product refers to'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only report what would be deleted')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        hashes, stored, sources = {}, {}, {}
+        products, missing = [], 0
+
+        for pk, name in Product.objects.order_by().exclude(image='').exclude(
+                image=None).values_list('id', 'image').iterator():
+            path = media_path(name)
+            if name not in hashes:
+                if not os.path.exists(path):
+                    missing += 1
+                    continue
+                hashes[name] = content_hash(path)
+            digest = hashes[name]
+            ext = os.path.splitext(name)[1].lower()
+            stored.setdefault(digest, f'{digest}{ext}')
+            sources.setdefault(digest, path)
+            products.append(Product(id=pk, image=stored[digest],
+                                    image_hash=digest, image_ready=True))
+
+        keep = set(stored.values())
+        for digest in stored:
+            keep.update(
+                derivative_name(directory, digest, image_format)
+                for directory, _, _ in Product.IMAGE_DERIVATIVES
+                for image_format in Product.IMAGE_FORMATS
+            )
+
+        if not dry_run:
+            for digest, name in stored.items():
+                if not os.path.exists(media_path(name)):
+                    shutil.copyfile(sources[digest], media_path(name))
+                if not os.path.exists(media_path(
+                        derivative_name('thumb', digest, 'JPEG'))):
+                    make_derivatives(media_path(name), digest,
+                                     Product.IMAGE_DERIVATIVES,
+                                     Product.IMAGE_FORMATS)
+
+            refcount = Counter(product.image_hash for product in products)
+            with transaction.atomic():
+                Product.objects.bulk_update(
+                    products, ['image', 'image_hash', 'image_ready'],
+                    batch_size=BATCH_SIZE
+                )
+                ProductImage.objects.all().delete()
+                ProductImage.objects.bulk_create([
+                    ProductImage(image_hash=digest, name=name,
+                                 refcount=refcount[digest], ready=True)
+                    for digest, name in stored.items()
+                ], batch_size=BATCH_SIZE)
+            products_changed.send(sender=Product,
+                                  ids={product.id for product in products})
+
+        # Файлы, на которые не ссылается ни один товар: старые имена
+        # {категория}_{id} и их производные, дубликаты
+        removed, freed = 0, 0
+        for directory in ('', 'big', 'card', 'thumb'):
+            if not os.path.isdir(media_path(directory)):
+                continue
+            for entry in os.scandir(media_path(directory)):
+                name = os.path.join(directory, entry.name)
+                ext = os.path.splitext(entry.name)[1].lower()
+                if not entry.is_file() or ext not in IMAGE_EXTENSIONS \
+                        or name in keep:
+                    continue
+                removed += 1
+                freed += entry.stat().st_size
+                if not dry_run:
+                    os.remove(entry.path)
+
+        # Варианты /img/ удаленных изображений
+        if os.path.isdir(media_path('img')):
+            for entry in os.scandir(media_path('img')):
+                if not entry.is_dir() or entry.name in stored:
+                    continue
+                for variant in os.scandir(entry.path):
+                    removed += 1
+                    freed += variant.stat().st_size
+                if not dry_run:
+                    shutil.rmtree(entry.path)
+
+        self.stdout.write(
+            f'Products: {len(products)}, unique images: {len(stored)}, '
+            f'missing files: {missing}\n'
+            f'{"Would delete" if dry_run else "Deleted"} {removed} files, '
+            f'{freed / 2 ** 20:.1f} MB'
+        )
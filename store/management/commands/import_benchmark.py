@@ -0,0 +1,155 @@
+import os
+import random
+import resource
+import shutil
+import time
+from xml.sax.saxutils import quoteattr
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from store.importers import AtolImporter, StockImporter
+
+ATOL_FIELDS = 60
+PRODUCTS_PER_CATEGORY = 100
+FIRST_PRODUCT_ID = 100000
+# Одинаковые файлы при каждом запуске: прогоны можно сравнивать
+DEFAULT_SEED = 0
+
+
+class Rollback(Exception):
+    pass
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def generate_atol(file, rows, seed=DEFAULT_SEED):
+    """ATOL csv: category rows without article and price, then products."""
+    rng = random.Random(seed)
+    categories = rows // PRODUCTS_PER_CATEGORY + 1
+    with open(file, 'w') as f:
+        for pk in range(1, categories + 1):
+            row = [''] * ATOL_FIELDS
+            row[0], row[2] = str(pk), f'Категория {pk}'
+            f.write(';'.join(row) + '\n')
+        for i in range(rows - categories):
+            row = [''] * ATOL_FIELDS
+            row[0] = str(FIRST_PRODUCT_ID + i)
+            row[2] = f'(ПР) Товар {i} кабель ПВС 3х{i % 7 + 1},5'
+            row[4] = f'{rng.randint(10, 100000) / 100:.2f}'
+            row[15] = str(i % categories + 1)
+            row[25] = f'{i % 10}-{i:05d}'
+            f.write(';'.join(row) + '\n')
+
+
+def generate_xml(file, rows, seed=DEFAULT_SEED):
+    """Stock xml in the format described in StockImporter."""
+    rng = random.Random(seed)
+    with open(file, 'w', encoding='windows-1251') as f:
+        f.write('<?xml version="1.0" encoding="windows-1251" ?>\n'
+                '<items date="22.02.21">\n')
+        for i in range(rows):
+            f.write(
+                f'<nom id="{FIRST_PRODUCT_ID + i}" '
+                f'name={quoteattr(f"Товар {i}")} art="{i:05d}">\n'
+                f'    <prices>\n'
+                f'        <price  name="Розничная" value="{i % 1000}"/>\n'
+                f'    </prices>\n'
+                f'    <whs>\n'
+                f'        <scl name="ЭЛЕКТРОН  ул. Ленина, 28" '
+                f'count="{rng.randint(0, 5)}" />\n'
+                f'        <scl name="Магазин-склад ЭЛЕКТРИКА" '
+                f'count="{rng.randint(0, 5)}" />\n'
+                f'    </whs>\n'
+                f'</nom>\n'
+            )
+        f.write('</items>\n')
+
+
+class Command(BaseCommand):
+    help = 'Dry run of the catalog importers with timings by phase'
+
+    importers = {
+        'atol': (AtolImporter, generate_atol),
+        'xml': (StockImporter, generate_xml),
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=self.importers)
+        parser.add_argument('file')
+        parser.add_argument('--generate', type=int, metavar='N',
+                            help='write a synthetic file of N rows first')
+        parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+                            help='random seed of the synthetic file')
+        parser.add_argument('--scratch', metavar='PATH',
+                            help='copy the sqlite database to PATH and '
+                                 'commit the import there')
+
+    def handle(self, *args, **options):
+        importer_class, generate = self.importers[options['kind']]
+        file = options['file']
+
+        if options['generate']:
+            started = time.perf_counter()
+            generate(file, options['generate'], options['seed'])
+            self.stdout.write(
+                f'Generated {options["generate"]} rows in {file} '
+                f'({time.perf_counter() - started:.1f} s)'
+            )
+        if not os.path.exists(file):
+            raise CommandError(f'File {file} not found')
+
+        if options['scratch']:
+            if connection.vendor != 'sqlite':
+                raise CommandError('--scratch works with sqlite only')
+            shutil.copyfile(connection.settings_dict['NAME'],
+                            options['scratch'])
+            connection.close()
+            connection.settings_dict['NAME'] = options['scratch']
+
+        # Манифест не сохраняется: прогон не должен влиять на ночной импорт.
+        # Витрина и версии каталога обновляются отдельно от run
+        importer = importer_class(use_manifest=False, notify=False)
+        queries, notify_queries = QueryCounter(), QueryCounter()
+        started = time.perf_counter()
+        try:
+            with transaction.atomic():
+                with connection.execute_wrapper(queries):
+                    summary = importer.run(file)
+                # Версии кэша меняются только после коммита: при откате
+                # сайт их не видит. Коммит в копию базы не должен сбросить
+                # кэш сайта, там notify не выполняется
+                if not options['scratch']:
+                    with connection.execute_wrapper(notify_queries), \
+                            importer.phase('notify'):
+                        importer.notify()
+                    raise Rollback
+        except Rollback:
+            pass
+        elapsed = time.perf_counter() - started - importer.timings['notify']
+
+        rows = sum(summary.values())
+        # ru_maxrss в Linux в килобайтах
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        self.stdout.write(f'Summary: {summary}')
+        for name in ('parse', 'lookup', 'write'):
+            self.stdout.write(f'{name:>8}: {importer.timings[name]:.2f} s')
+        self.stdout.write(
+            f'   total: {elapsed:.2f} s, {rows / elapsed:.0f} rows/s\n'
+            f' queries: {queries.count}\n'
+            f'peak RSS: {peak_rss:.1f} MB'
+        )
+        if not options['scratch']:
+            self.stdout.write(
+                f'  notify: {importer.timings["notify"]:.2f} s, '
+                f'{notify_queries.count} queries'
+            )
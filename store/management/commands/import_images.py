@@ -0,0 +1,129 @@
+import os
+import shutil
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from store.images import content_hash, make_derivatives, media_path, \
+    derivative_name
+from store.importers import BATCH_SIZE
+from store.models import Product, ProductImage
+from store.signals import products_changed
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def process_image(path, pk, category_id, image_hash):
+    """
+    Runs in a worker process: copy the photo into MEDIA_ROOT and write its
+    derivatives unless they are stored already. Returns
+    (pk, name, hash, previous hash) or None if the product already has
+    this photo.
+    """
+    digest = content_hash(path)
+    if digest == image_hash:
+        return None
+
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    name = f'{digest}.{ext}'
+    # Производные пишутся от большей к меньшей, миниатюра - последней
+    if not os.path.exists(media_path(derivative_name('thumb', digest,
+                                                     'JPEG'))):
+        shutil.copyfile(path, media_path(name))
+        make_derivatives(path, digest, Product.IMAGE_DERIVATIVES,
+                         Product.IMAGE_FORMATS)
+    return pk, name, digest, image_hash
+
+
+class Command(BaseCommand):
+    help = 'Attach photos from a directory to products matched by ' \
+           'file name: product id or article'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+
+    def match(self, directory):
+        """Yield (path, product values) for every photo with a product."""
+        by_id, by_article = {}, {}
+        for values in Product.objects.order_by().values_list(
+                'id', 'article', 'category_id', 'image_hash').iterator():
+            by_id[str(values[0])] = values
+            by_article.setdefault(values[1], values)
+
+        unmatched, seen = 0, set()
+        for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+            stem, ext = os.path.splitext(entry.name)
+            if not entry.is_file() or ext.lower() not in IMAGE_EXTENSIONS:
+                continue
+            values = by_id.get(stem) or by_article.get(stem)
+            if values and values[0] not in seen:
+                seen.add(values[0])
+                yield entry.path, values
+            elif not values:
+                unmatched += 1
+        self.unmatched = unmatched
+
+    def attach(self, results):
+        products = [Product(id=pk, image=name, image_hash=digest,
+                            image_ready=True)
+                    for pk, name, digest, _ in results]
+        acquired = Counter((digest, name) for _, name, digest, _ in results)
+        released = Counter(old for *_, old in results if old)
+        with transaction.atomic():
+            Product.objects.bulk_update(
+                products, ['image', 'image_hash', 'image_ready'],
+                batch_size=BATCH_SIZE
+            )
+            for (image_hash, name), count in acquired.items():
+                ProductImage.acquire(image_hash, name, count, ready=True)
+            for image_hash, count in released.items():
+                ProductImage.release(image_hash, count)
+        products_changed.send(sender=Product,
+                              ids={product.id for product in products})
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options['directory']):
+            raise CommandError(f'{options["directory"]} is not a directory')
+
+        started = time.perf_counter()
+        done, skipped, failed = 0, 0, 0
+        results = []
+
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            futures = [
+                pool.submit(process_image, path, pk, category_id, image_hash)
+                for path, (pk, _, category_id, image_hash)
+                in self.match(options['directory'])
+            ]
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(str(e))
+                    continue
+                if result is None:
+                    skipped += 1
+                    continue
+                results.append(result)
+                # Прикрепляем порциями: прерванный запуск можно продолжить,
+                # готовые фото будут пропущены по хэшу
+                if len(results) >= BATCH_SIZE:
+                    self.attach(results)
+                    done += len(results)
+                    results = []
+
+        if results:
+            self.attach(results)
+            done += len(results)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'Attached: {done}, already done: {skipped}, failed: {failed}, '
+            f'no product: {self.unmatched}\n'
+            f'{elapsed:.1f} s, {(done + skipped) / elapsed:.1f} images/s'
+        )
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from store.models import PublishedProduct
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the storefront projection of displayed products'
+
+    def handle(self, *args, **options):
+        PublishedProduct.objects.rebuild()
+        self.stdout.write(
+            f'Published {PublishedProduct.objects.count()} products')
@@ -0,0 +1,29 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.stock import parse_stock_updates, apply_stock_updates
+
+
+class Command(BaseCommand):
+    help = 'Apply stock counts [{"id", "warehouse1", "warehouse2"}] ' \
+           'from a json file or stdin'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', nargs='?', default='-')
+
+    def handle(self, *args, **options):
+        try:
+            if options['file'] == '-':
+                items = json.load(sys.stdin)
+            else:
+                with open(options['file']) as f:
+                    items = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+
+        updates, rejected = parse_stock_updates(items)
+        changed = apply_stock_updates(updates)
+        self.stdout.write(f'Accepted: {len(updates)}, rejected: {rejected}, '
+                          f'changed: {len(changed)}')
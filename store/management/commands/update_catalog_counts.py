@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Category
+
+
+class Command(BaseCommand):
+    help = 'Recount products and products in stock of all categories ' \
+           'and groups'
+
+    def handle(self, *args, **options):
+        ids = list(Category.objects.order_by().values_list('id', flat=True))
+        Category.objects.update_counts(ids)
+        self.stdout.write(f'Recounted {len(ids)} categories')
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.8 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_order_payment_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='image_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='image_ready',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.8 on 2026-10-18 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    The old per-product ProductImage table is not used by the code any
+    more; images are now stored once per content hash.
+    """
+
+    dependencies = [
+        ('store', '0007_product_image_hash'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='ProductImage',
+        ),
+        migrations.CreateModel(
+            name='ProductImage',
+            fields=[
+                ('image_hash', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=100)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('ready', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
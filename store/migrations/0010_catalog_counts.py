@@ -0,0 +1,37 @@
+# Generated by Django 3.1.8 on 2026-10-18 20:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """Counts are filled by manage.py update_catalog_counts."""
+
+    dependencies = [
+        ('store', '0009_product_category_title_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='product_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Товаров'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='in_stock_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В наличии'),
+        ),
+        # Модели Group нет в истории миграций, столбцы добавляются SQL
+        migrations.RunSQL(
+            [
+                'ALTER TABLE store_group ADD COLUMN product_count '
+                'integer NOT NULL DEFAULT 0',
+                'ALTER TABLE store_group ADD COLUMN in_stock_count '
+                'integer NOT NULL DEFAULT 0',
+            ],
+            reverse_sql=[
+                'ALTER TABLE store_group DROP COLUMN product_count',
+                'ALTER TABLE store_group DROP COLUMN in_stock_count',
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.1.8 on 2026-10-18 21:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """Rows are filled by manage.py rebuild_published_catalog."""
+
+    dependencies = [
+        ('store', '0010_catalog_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublishedProduct',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('article', models.CharField(max_length=50)),
+                ('title', models.CharField(max_length=255)),
+                ('price', models.DecimalField(decimal_places=2, default=0, max_digits=9)),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('in_stock', models.BooleanField(default=False)),
+                ('category_id', models.IntegerField()),
+                ('category_name', models.CharField(max_length=255)),
+                ('group_id', models.IntegerField()),
+                ('group_name', models.CharField(max_length=255)),
+                ('image_name', models.CharField(max_length=255)),
+                ('image_webp', models.CharField(max_length=255)),
+                ('thumb_url', models.CharField(max_length=255)),
+            ],
+            options={
+                'verbose_name': 'Товар витрины',
+                'verbose_name_plural': 'Товары витрины',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='publishedproduct',
+            index=models.Index(fields=['category_id', 'title', 'id'], name='published_category_title_id'),
+        ),
+        migrations.AddIndex(
+            model_name='publishedproduct',
+            index=models.Index(fields=['article'], name='published_article'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.8 on 2026-10-18 22:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """Rows are filled by manage.py rebuild_published_catalog."""
+
+    dependencies = [
+        ('store', '0011_publishedproduct'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=100)),
+                ('product', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='terms', to='store.publishedproduct')),
+            ],
+            options={
+                'verbose_name': 'Слово поиска',
+                'verbose_name_plural': 'Слова поиска',
+                'unique_together': {('term', 'product')},
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.1.8 on 2026-10-18 23:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """Keys are filled by 0014_fill_published_catalog."""
+
+    dependencies = [
+        ('store', '0012_searchterm'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='publishedproduct',
+            name='published_article',
+        ),
+        migrations.AddField(
+            model_name='publishedproduct',
+            name='article_key',
+            field=models.CharField(default='', max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='publishedproduct',
+            index=models.Index(fields=['article_key'], name='published_article_key'),
+        ),
+    ]
@@ -0,0 +1,67 @@
+from django.db import migrations
+
+from store.images import derivative_name
+from store.models import NO_IMAGE_URL, NO_IMAGE_THUMB, COUNT_BATCH_SIZE
+from store.utils import article_key, search_terms
+
+
+def image_url(product, directory, image_format='JPEG'):
+    # Как Product.image_url: в миграции модели без методов
+    if not product.image or not product.image_ready:
+        return None
+    if not product.image_hash:
+        if image_format != 'JPEG':
+            return None
+        return f'/media/{directory}/{product.image.name}'
+    name = derivative_name(directory, product.image_hash, image_format)
+    return f'/media/{name}'
+
+
+def fill_published_catalog(apps, schema_editor):
+    """Витрина и поисковый индекс из уже заведенных товаров."""
+    Product = apps.get_model('store', 'Product')
+    PublishedProduct = apps.get_model('store', 'PublishedProduct')
+    SearchTerm = apps.get_model('store', 'SearchTerm')
+
+    SearchTerm.objects.all().delete()
+    PublishedProduct.objects.all().delete()
+    rows, terms = [], []
+    for product in Product.objects.filter(display=True).select_related(
+            'category__parent').order_by().iterator():
+        category = product.category
+        quantity = product.warehouse1 + product.warehouse2
+        image_name = image_url(product, 'card') or NO_IMAGE_URL
+        rows.append(PublishedProduct(
+            id=product.id, article=product.article,
+            article_key=article_key(product.article), title=product.title,
+            price=product.price, quantity=quantity, in_stock=quantity > 0,
+            category_id=category.id, category_name=category.name,
+            group_id=category.parent_id, group_name=category.parent.name,
+            image_name=image_name,
+            image_webp=image_url(product, 'card', 'WEBP') or image_name,
+            thumb_url=image_url(product, 'thumb') or NO_IMAGE_THUMB,
+        ))
+        terms.extend(SearchTerm(product_id=product.id, term=term)
+                     for term in search_terms(product.title, product.article))
+        if len(rows) >= COUNT_BATCH_SIZE:
+            PublishedProduct.objects.bulk_create(rows)
+            SearchTerm.objects.bulk_create(terms, batch_size=COUNT_BATCH_SIZE)
+            rows, terms = [], []
+    PublishedProduct.objects.bulk_create(rows)
+    SearchTerm.objects.bulk_create(terms, batch_size=COUNT_BATCH_SIZE)
+
+
+def clear_published_catalog(apps, schema_editor):
+    apps.get_model('store', 'SearchTerm').objects.all().delete()
+    apps.get_model('store', 'PublishedProduct').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_publishedproduct_article_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_published_catalog, clear_published_catalog),
+    ]
@@ -1,7 +1,45 @@
+import hashlib
+
+from django.conf import settings
 from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.functional import cached_property
 from django.views.generic import View
 
 from .models import Order, Customer, Article
+from .conditional import catalog_condition, page_versions, \
+    versions_stamp
+
+PAGE_CACHE_TIMEOUT = 60 * 60
+# Корзины старше двух дней удаляет AddToCartView
+CART_SUMMARY_TIMEOUT = 2 * 24 * 60 * 60
+
+
+def cart_summary_key(session):
+    return f'cart:{session}'
+
+
+def summarize_cart(order):
+    return {
+        'count': order.total_products if order else 0,
+        'total': order.total_price_gross if order else 0,
+        'order_id': order.id if order else None,
+    }
+
+
+def get_cart_summary(session):
+    """
+    Cart badge of a customersession: item count, total and order id. It is
+    cached until a cart view changes the cart, see CartMixin.cart_changed.
+    """
+    if not session:
+        return summarize_cart(None)
+    summary = cache.get(cart_summary_key(session))
+    if summary is None:
+        order = Order.carts.filter(owner__session=session).first()
+        summary = summarize_cart(order)
+        cache.set(cart_summary_key(session), summary, CART_SUMMARY_TIMEOUT)
+    return summary
 
 
 class CartMixin(View):
@@ -11,17 +49,70 @@ class CartMixin(View):
         self.articles = cache.get_or_set('article_menu',
                                          Article.objects.all(), timeout=600)
 
-    def dispatch(self, request, *args, **kwargs):
+    @cached_property
+    def order(self):
+        # Корзина читается только видами, которым она нужна
+        return self.get_cart(self.request)
+
+    def get_cart(self, request):
 
         try:
             session = request.COOKIES.get('customersession')
             customer = Customer.objects.get(session=session)
-            self.order = Order.carts.get(owner=customer)
+            return Order.carts.get(owner=customer)
 
         except:
-            self.order = None
+            return None
+
+    def cart_changed(self, session=None):
+        """Store the cart summary after the cart view changed the cart."""
+        session = session or self.request.COOKIES.get('customersession')
+        if session:
+            cache.set(cart_summary_key(session), summarize_cart(self.order),
+                      CART_SUMMARY_TIMEOUT)
+
+
+class PageCacheMixin(CartMixin):
+    """
+    Whole page cache of catalog pages for visitors without a django
+    session: they are not logged in and have no view settings, so the page
+    is the same for all of them. The cart badge and messages of such pages
+    are loaded by base.html from CartSummaryView.
+
+    A page is cached under the versions of its page_scopes, the same ones
+    give its ETag and Last-Modified, see store.conditional: a change of one
+    product does not drop the pages of the others.
+    """
+    page_scopes = ('tree',)
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method != 'GET' or \
+                settings.SESSION_COOKIE_NAME in request.COOKIES:
+            return super().dispatch(request, *args, **kwargs)
+        cached_dispatch = catalog_condition(*self.page_scopes)(
+            self.cached_dispatch)
+        return cached_dispatch(request, *args, **kwargs)
+
+    def cached_dispatch(self, request, *args, **kwargs):
+        stamp = versions_stamp(page_versions(request, self.page_scopes,
+                                             kwargs))
+        path = hashlib.md5(
+            f'{request.get_full_path()}:{stamp}'.encode()).hexdigest()
+        key = f'page:{path}'
+        page = cache.get(key)
+        if page is not None:
+            content, content_type = page
+            return HttpResponse(content, content_type=content_type)
 
-        return super().dispatch(request, *args, **kwargs)
+        request.page_cache = True
+        response = super().dispatch(request, *args, **kwargs)
+        # Страница, записавшая настройки в сессию, уже не общая
+        if response.status_code == 200 and not request.session.modified:
+            if hasattr(response, 'render'):
+                response.render()
+            cache.set(key, (response.content, response['Content-Type']),
+                      PAGE_CACHE_TIMEOUT)
+        return response
 
 
 class RequiredFieldsMixin:
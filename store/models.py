@@ -1,16 +1,27 @@
-import os
-from PIL import Image
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q, Count, Sum, OuterRef, Subquery
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.html import mark_safe
 
-from electron import settings
-from store.utils import path_and_rename
+from store.images import content_hash, derivative_name, delete_image_files
+from store.fragments import invalidate_products
+from store.signals import products_changed
+from store.utils import path_and_rename, bump_catalog_version, \
+    search_terms, article_key, article_trigrams, edit_distance, TERM_LENGTH
 
 NO_IMAGE_URL = '/static/img/no_image.png'
 NO_IMAGE_THUMB = '/static/img/no_image_thumb.png'
+# Категорий в одном запросе пересчета
+COUNT_BATCH_SIZE = 500
+# Поиск по артикулу с опечатками, см. PublishedProductManager.find_article
+ARTICLE_LIMIT = 20
+ARTICLE_CANDIDATES = 200
+ARTICLE_DISTANCE = 2
+ARTICLE_DISTANCE_LENGTH = 6
 
 
 class Group(models.Model):
@@ -21,6 +32,11 @@ class Group(models.Model):
 
     id = models.IntegerField(primary_key=True)
     name = models.CharField(max_length=255, verbose_name='Группа')
+    # Поддерживаются CategoryManager.update_counts
+    product_count = models.PositiveIntegerField(
+        verbose_name='Товаров', default=0, editable=False)
+    in_stock_count = models.PositiveIntegerField(
+        verbose_name='В наличии', default=0, editable=False)
 
     def __str__(self):
         return self.name
@@ -34,12 +50,62 @@ class CategoryManager(models.Manager):
     def get_queryset(self):
         return super().get_queryset()
 
-    def get_category_list(self):
-        q = self.get_queryset().annotate()
-        data = [
-            dict(name=c.name, url=c.get_absolute_url()) for c in q
-        ]
-        return data
+    def update_counts(self, category_ids):
+        """
+        Recount products and products in stock of the given categories and
+        of their groups. Only these rows are touched, one aggregate query
+        per COUNT_BATCH_SIZE categories.
+        """
+        category_ids = sorted(set(category_ids) - {None})
+        # Считаются только выставляемые товары, как на витрине
+        shown = Q(product__display=True)
+        in_stock = shown & (Q(product__warehouse1__gt=0)
+                            | Q(product__warehouse2__gt=0))
+        categories, changed, group_ids = [], [], set()
+        for i in range(0, len(category_ids), COUNT_BATCH_SIZE):
+            rows = self.filter(
+                id__in=category_ids[i:i + COUNT_BATCH_SIZE]
+            ).order_by().annotate(
+                total=Count('product', filter=shown),
+                in_stock=Count('product', filter=in_stock),
+            ).values_list('id', 'parent_id', 'total', 'in_stock',
+                          'product_count', 'in_stock_count')
+            for pk, parent_id, total, stock, old_total, old_stock in rows:
+                categories.append(pk)
+                if (total, stock) != (old_total, old_stock):
+                    changed.append(self.model(id=pk, product_count=total,
+                                              in_stock_count=stock))
+                    group_ids.add(parent_id)
+        if not categories:
+            return
+
+        groups = []
+        with transaction.atomic():
+            self.bulk_update(changed, ['product_count', 'in_stock_count'],
+                             batch_size=COUNT_BATCH_SIZE)
+            old_counts = {
+                pk: (total, stock) for pk, total, stock in
+                Group.objects.filter(id__in=group_ids).order_by()
+                .values_list('id', 'product_count', 'in_stock_count')
+            }
+            for parent_id, total, stock in self.filter(
+                parent_id__in=group_ids
+            ).order_by().values('parent_id').annotate(
+                total=Sum('product_count'),
+                in_stock=Sum('in_stock_count'),
+            ).values_list('parent_id', 'total', 'in_stock'):
+                if old_counts.get(parent_id) != (total, stock):
+                    groups.append(Group(id=parent_id, product_count=total,
+                                        in_stock_count=stock))
+            Group.objects.bulk_update(
+                groups, ['product_count', 'in_stock_count'])
+        # Товары категорий изменились всегда; группа показывает числа
+        # своих категорий, даже если ее сумма та же
+        scopes = [f'category:{pk}' for pk in categories]
+        scopes += [f'group:{pk}' for pk in group_ids]
+        if changed:
+            scopes.append('counts')
+        bump_catalog_version(scopes)
 
 
 class Category(models.Model):
@@ -53,6 +119,10 @@ class Category(models.Model):
                                blank=False, default=1,
                                on_delete=models.CASCADE)
     name = models.CharField(max_length=255, verbose_name='Категория')
+    product_count = models.PositiveIntegerField(
+        verbose_name='Товаров', default=0, editable=False)
+    in_stock_count = models.PositiveIntegerField(
+        verbose_name='В наличии', default=0, editable=False)
     objects = CategoryManager()
 
     def __str__(self):
@@ -62,16 +132,67 @@ class Category(models.Model):
         return reverse('category_detail', kwargs={'pk': self.pk})
 
 
+class ProductImage(models.Model):
+    """
+    Изображение, хранимое один раз на содержимое: оригинал <hash>.<ext> и
+    производные по image_hash. refcount - число товаров с этим изображением,
+    файлы удаляются вместе с последней ссылкой.
+    """
+    image_hash = models.CharField(max_length=32, primary_key=True)
+    name = models.CharField(max_length=100)
+    refcount = models.PositiveIntegerField(default=0)
+    # Производные изображения построены
+    ready = models.BooleanField(default=False)
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def acquire(cls, image_hash, name, count=1, ready=False):
+        cls.objects.get_or_create(image_hash=image_hash,
+                                  defaults={'name': name, 'ready': ready})
+        cls.objects.filter(pk=image_hash).update(
+            refcount=F('refcount') + count)
+
+    @classmethod
+    def release(cls, image_hash, count=1):
+        """Drop references, delete the files after commit if none left."""
+        with transaction.atomic():
+            stored = cls.objects.select_for_update().filter(
+                pk=image_hash).first()
+            if not stored:
+                return
+            if stored.refcount > count:
+                cls.objects.filter(pk=image_hash).update(
+                    refcount=F('refcount') - count)
+                return
+            stored.delete()
+        transaction.on_commit(lambda: delete_image_files(
+            stored.name, image_hash, Product.IMAGE_DERIVATIVES,
+            Product.IMAGE_FORMATS
+        ))
+
+
 class Product(models.Model):
     class Meta:
         verbose_name = 'Товар'
         verbose_name_plural = '2. Товары'
         ordering = ('category', 'title')
+        # Постраничный вывод категории по ключу (title, id)
+        indexes = [models.Index(fields=['category', 'title', 'id'],
+                                name='product_category_title_id')]
 
     PRODUCT_BIG = (1100, 3000)
     PRODUCT_CARD = (300, 400)
     PRODUCT_THUMB = (50, 50)
     MAX_IMAGE_SIZE = 4145728
+    # Производные изображения: (каталог в MEDIA_ROOT, размер, качество)
+    IMAGE_DERIVATIVES = (
+        ('big', PRODUCT_BIG, 95),
+        ('card', PRODUCT_CARD, 85),
+        ('thumb', PRODUCT_THUMB, 75),
+    )
+    IMAGE_FORMATS = ('JPEG', 'WEBP')
 
     category = models.ForeignKey(Category, verbose_name='Категория',
                                  null=False, blank=False, default=1,
@@ -86,6 +207,9 @@ class Product(models.Model):
     warehouse2 = models.PositiveIntegerField(verbose_name='Склад ЭЛЕКТРИКА', default=0)
     display = models.BooleanField(verbose_name='Выставлять', default=True,
                                   blank=False, null=False)
+    image_hash = models.CharField(max_length=32, blank=True, editable=False)
+    # Производные изображения для image_hash готовы
+    image_ready = models.BooleanField(default=True, editable=False)
 
     def __str__(self):
         return self.title
@@ -98,36 +222,325 @@ class Product(models.Model):
         return reverse('product_detail', kwargs={'pk': self.pk})
 
     def save(self, *args, **kwargs):
-        image = self.image
-        if image:
-            img = Image.open(image)
+        # Производные изображения строит задача make_product_images и
+        # только для содержимого, которого еще нет в ProductImage
+        old_hash, new_image = None, False
+        if self.image and not self.image._committed:
+            image_hash = content_hash(self.image)
+            if image_hash != self.image_hash:
+                old_hash, self.image_hash = self.image_hash, image_hash
+                stored = ProductImage.objects.filter(pk=image_hash).first()
+                if stored:
+                    # Такое изображение уже есть - ссылаемся на него
+                    self.image = stored.name
+                    self.image_ready = stored.ready
+                else:
+                    self.image_ready = False
+                    new_image = True
+            elif self.pk:
+                # Тот же файл загружен повторно - оставить прежний
+                self.image = Product.objects.values_list(
+                    'image', flat=True).get(pk=self.pk)
+        elif not self.image and self.image_hash:
+            # Изображение удалено
+            old_hash, self.image_hash = self.image_hash, ''
+
+        old_category = None
+        if self.pk:
+            old_category = Product.objects.filter(pk=self.pk).order_by() \
+                .values_list('category_id', flat=True).first()
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if old_hash is not None and self.image_hash:
+                ProductImage.acquire(self.image_hash, self.image.name)
+            if old_hash:
+                ProductImage.release(old_hash)
+            products_changed.send(
+                sender=Product, ids={self.pk},
+                categories={self.category_id, old_category},
+            )
+
+        if new_image:
+            from store.tasks import make_product_images
+            pk, image_hash = self.pk, self.image_hash
+            transaction.on_commit(
+                lambda: make_product_images.delay(pk, image_hash)
+            )
 
-            ext = image.name.split('.')[-1]
-            filename = f'{self.category.pk}_{self.pk}.{ext}'
+    def image_url(self, directory, image_format='JPEG'):
+        """Derivative image url or None while it is not generated yet."""
+        if not self.image or not self.image_ready:
+            return None
+        if not self.image_hash:
+            # Изображения, загруженные до появления image_hash
+            if image_format != 'JPEG':
+                return None
+            return f'/media/{directory}/{self.image.name}'
+        name = derivative_name(directory, self.image_hash, image_format)
+        return f'/media/{name}'
+
+    def thumb_url(self):
+        return self.image_url('thumb') or NO_IMAGE_THUMB
 
-            img.thumbnail(self.PRODUCT_BIG, Image.ANTIALIAS)
-            img.save(os.path.join(settings.MEDIA_ROOT, filename),
-                     'JPEG', quality=95)
+    def image_thumb(self):
+        return mark_safe(
+            f'<img src="{self.thumb_url()}" width="50" height="50" />'
+        )
 
-            img.thumbnail(self.PRODUCT_CARD, Image.ANTIALIAS)
-            img.save(os.path.join(settings.MEDIA_ROOT, 'card', filename),
-                     'JPEG', quality=85)
+    image_thumb.short_description = 'Изображение'
 
-            img.thumbnail(self.PRODUCT_THUMB)
-            img.save(os.path.join(settings.MEDIA_ROOT, 'thumb', filename))
+    def image_name(self):
+        return self.image_url('card') or NO_IMAGE_URL
+
+    def image_webp(self):
+        return self.image_url('card', 'WEBP') or self.image_name()
+
+
+class PublishedProductManager(models.Manager):
+
+    def refresh(self, ids):
+        """
+        Rewrite the rows of the given products from Product: changed ones
+        are updated, deleted and hidden (display=False) ones are removed.
+        """
+        ids = sorted(set(ids))
+        for i in range(0, len(ids), COUNT_BATCH_SIZE):
+            batch = ids[i:i + COUNT_BATCH_SIZE]
+            rows = [
+                self.model.from_product(product)
+                for product in Product.objects.filter(
+                    id__in=batch, display=True
+                ).select_related('category__parent').order_by()
+            ]
+            terms = [
+                SearchTerm(product_id=row.id, term=term)
+                for row in rows
+                for term in search_terms(row.title, row.article)
+            ]
+            with transaction.atomic():
+                SearchTerm.objects.filter(product_id__in=batch).delete()
+                self.filter(id__in=batch).delete()
+                self.bulk_create(rows)
+                SearchTerm.objects.bulk_create(terms,
+                                               batch_size=COUNT_BATCH_SIZE)
+
+    def refresh_names(self, **filters):
+        """Names of categories and groups after their change."""
+        category = Category.objects.filter(id=OuterRef('category_id'))
+        group = Group.objects.filter(category__id=OuterRef('category_id'))
+        self.filter(**filters).update(
+            category_name=Subquery(category.values('name')[:1]),
+            group_id=Subquery(category.values('parent_id')[:1]),
+            group_name=Subquery(group.values('name')[:1]),
+        )
 
-        super().save(*args, **kwargs)
+    def search(self, terms):
+        """
+        Products with the terms of a query (store.utils.query_terms), most
+        matched terms first, then products in stock.
+        """
+        return self.filter(terms__term__in=terms).annotate(
+            matches=Count('terms'),
+        ).order_by('-matches', '-in_stock', 'title', 'id')
+
+    def find_article(self, text, limit=ARTICLE_LIMIT):
+        """
+        Ids of products by article: equal article keys (store.utils.
+        article_key), else the keys within ARTICLE_DISTANCE edits. The
+        candidates of the second step share article trigrams with the
+        query in SearchTerm, the distance is checked only for them.
+        """
+        key = article_key(text)
+        if not key:
+            return []
+        ids = list(self.filter(article_key=key).order_by('title', 'id')
+                   .values_list('id', flat=True)[:limit])
+        if ids:
+            return ids
+
+        distance = 1 if len(key) <= ARTICLE_DISTANCE_LENGTH \
+            else ARTICLE_DISTANCE
+        trigrams = article_trigrams(key)
+        # Одна правка меняет не больше трех триграмм
+        candidates = SearchTerm.objects.filter(term__in=trigrams).values(
+            'product_id').annotate(shared=Count('id')).filter(
+            shared__gte=max(1, len(trigrams) - 3 * distance)
+        ).order_by('-shared').values_list('product_id', flat=True)
+        found = []
+        for pk, candidate in self.filter(
+                id__in=list(candidates[:ARTICLE_CANDIDATES])
+        ).values_list('id', 'article_key'):
+            edits = edit_distance(key, candidate)
+            if edits <= distance:
+                found.append((edits, pk))
+        return [pk for edits, pk in sorted(found)[:limit]]
+
+    def rebuild(self):
+        with transaction.atomic():
+            SearchTerm.objects.all().delete()
+            self.all().delete()
+            self.refresh(Product.objects.order_by().values_list(
+                'id', flat=True))
+        # 'tree' входит в ETag всех страниц каталога
+        bump_catalog_version(['tree'])
+
+
+class PublishedProduct(models.Model):
+    """
+    Витрина: выставляемые товары одной таблицей со всем, что нужно
+    страницам каталога. Только для чтения, строки пишет
+    PublishedProductManager.refresh по products_changed.
+    """
+    class Meta:
+        verbose_name = 'Товар витрины'
+        verbose_name_plural = 'Товары витрины'
+        indexes = [
+            models.Index(fields=['category_id', 'title', 'id'],
+                         name='published_category_title_id'),
+            models.Index(fields=['article_key'],
+                         name='published_article_key'),
+        ]
+
+    id = models.IntegerField(primary_key=True)
+    article = models.CharField(max_length=50)
+    # Артикул для поиска, см. store.utils.article_key
+    article_key = models.CharField(max_length=50, default='')
+    title = models.CharField(max_length=255)
+    price = models.DecimalField(max_digits=9, decimal_places=2, default=0)
+    quantity = models.PositiveIntegerField(default=0)
+    in_stock = models.BooleanField(default=False)
+    category_id = models.IntegerField()
+    category_name = models.CharField(max_length=255)
+    group_id = models.IntegerField()
+    group_name = models.CharField(max_length=255)
+    # Адреса изображений, как у Product.image_name, image_webp, thumb_url
+    image_name = models.CharField(max_length=255)
+    image_webp = models.CharField(max_length=255)
+    thumb_url = models.CharField(max_length=255)
+
+    objects = PublishedProductManager()
+
+    def __str__(self):
+        return self.title
+
+    @classmethod
+    def from_product(cls, product):
+        category = product.category
+        return cls(
+            id=product.id, article=product.article,
+            article_key=article_key(product.article), title=product.title,
+            price=product.price, quantity=product.quantity,
+            in_stock=product.quantity > 0,
+            category_id=category.id, category_name=category.name,
+            group_id=category.parent_id, group_name=category.parent.name,
+            image_name=product.image_name(), image_webp=product.image_webp(),
+            thumb_url=product.thumb_url(),
+        )
+
+    def get_absolute_url(self):
+        return reverse('product_detail', kwargs={'pk': self.pk})
+
+    def category_url(self):
+        return reverse('category_detail', kwargs={'pk': self.category_id})
+
+    def group_url(self):
+        return reverse('group_detail', kwargs={'pk': self.group_id})
 
     def image_thumb(self):
-        img_src = f"/media/thumb/{self.image}" if self.image else NO_IMAGE_THUMB
         return mark_safe(
-            f'<img src="{img_src}" width="50" height="50" />'
+            f'<img src="{self.thumb_url}" width="50" height="50" />'
         )
 
-    image_thumb.short_description = 'Изображение'
 
-    def image_name(self):
-        return f"/media/card/{self.image}" if self.image else NO_IMAGE_URL
+class SearchTerm(models.Model):
+    """
+    Поисковый индекс витрины: нормальные формы слов наименования и
+    артикул без разделителей, см. store.utils.search_terms
+    """
+    class Meta:
+        verbose_name = 'Слово поиска'
+        verbose_name_plural = 'Слова поиска'
+        unique_together = ('term', 'product')
+
+    term = models.CharField(max_length=TERM_LENGTH)
+    product = models.ForeignKey(PublishedProduct, related_name='terms',
+                                on_delete=models.DO_NOTHING,
+                                db_constraint=False)
+
+
+@receiver(post_delete, sender=Product)
+def release_product_image(sender, instance, **kwargs):
+    # В том числе при каскадном удалении вместе с категорией
+    if instance.image_hash:
+        ProductImage.release(instance.image_hash)
+    PublishedProduct.objects.refresh({instance.pk})
+    invalidate_products({instance.pk})
+    Category.objects.update_counts({instance.category_id})
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def catalog_tree_changed(sender, instance, **kwargs):
+    # Строки удаленных вместе с товарами уже убраны release_product_image
+    if kwargs.get('created') is False:
+        field = 'group_id' if sender is Group else 'category_id'
+        PublishedProduct.objects.refresh_names(**{field: instance.pk})
+    bump_catalog_version(['tree'])
+
+
+@receiver(products_changed)
+def refresh_published_products(sender, ids, **kwargs):
+    # Витрина раньше версий каталога: новая версия - новые строки
+    PublishedProduct.objects.refresh(ids)
+
+
+@receiver(products_changed)
+def update_catalog_counts(sender, ids, categories=None, **kwargs):
+    # Без categories товары не переходили между категориями
+    if categories is None:
+        categories = set()
+        ids = sorted(ids)
+        for i in range(0, len(ids), COUNT_BATCH_SIZE):
+            categories.update(Product.objects.filter(
+                id__in=ids[i:i + COUNT_BATCH_SIZE]
+            ).order_by().values_list('category_id', flat=True).distinct())
+    Category.objects.update_counts(categories)
+
+
+@receiver(products_changed)
+def bump_product_versions(sender, ids, **kwargs):
+    # Цена, остаток или изображение изменились: карточки перерисовать,
+    # ETag страницы товара сменить
+    invalidate_products(ids)
+
+
+class CategoryStaging(models.Model):
+    """Категории нового каталога до публикации, см. store.staging"""
+    class Meta:
+        managed = False
+        db_table = 'store_category_staging'
+
+    id = models.IntegerField(primary_key=True)
+    name = models.CharField(max_length=255)
+
+
+class ProductStaging(models.Model):
+    """Товары нового каталога до публикации, см. store.staging"""
+    class Meta:
+        managed = False
+        db_table = 'store_product_staging'
+
+    category = models.ForeignKey(CategoryStaging, db_constraint=False,
+                                 on_delete=models.DO_NOTHING)
+    article = models.CharField(max_length=50)
+    title = models.CharField(max_length=255)
+    price = models.DecimalField(max_digits=9, decimal_places=2, default=0)
+    # NULL - товара нет в файле остатков, остатки не меняются
+    warehouse1 = models.PositiveIntegerField(null=True)
+    warehouse2 = models.PositiveIntegerField(null=True)
 
 
 class Customer(models.Model):
@@ -177,10 +590,7 @@ class OrderProduct(models.Model):
         super().save(*args, **kwargs)
 
     def image_thumb(self):
-        img_src = f"/media/thumb/{self.product.image}" if self.product.image else NO_IMAGE_THUMB
-        return mark_safe(
-            f'<img src="{img_src}" width="50" height="50" />'
-        )
+        return self.product.image_thumb()
 
     image_thumb.short_description = 'Изображение'
 
@@ -0,0 +1,96 @@
+from django.db.models import Q
+
+
+class KeysetPage:
+    """
+    Page of a keyset pagination with the interface of django Page used by
+    the templates. Neighbour pages are addressed by the id of the edge
+    product: ?after=<id of the last one>, ?before=<id of the first one>.
+    """
+
+    def __init__(self, object_list, count, has_next, has_previous, cursor):
+        self.object_list = object_list
+        self.count = count
+        self._has_next = has_next
+        self._has_previous = has_previous
+        # Строка запроса текущей страницы, для смены вида и размера
+        self.cursor = cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        return self.object_list[-1].pk if self.object_list else None
+
+    @property
+    def previous_cursor(self):
+        return self.object_list[0].pk if self.object_list else None
+
+
+def keyset_page(queryset, field, per_page, count, after=None, before=None,
+                last=False):
+    """
+    Page of queryset ordered by (field, id) that starts right after the
+    object with id=after or ends right before id=before; with last=True
+    the last page. An index on (..., field, id) makes every page cost the
+    same as the first one: no OFFSET and no COUNT.
+    """
+    forward = (field, 'id')
+    backward = (f'-{field}', '-id')
+
+    cursor, pk = '', None
+    for name, value in (('after', after), ('before', before)):
+        try:
+            pk = int(value)
+        except (TypeError, ValueError):
+            continue
+        # Курсор только из этой же выборки, без сортировки модели
+        key = queryset.filter(pk=pk).order_by() \
+            .values_list(field, flat=True).first()
+        if key is not None:
+            cursor = f'{name}={pk}'
+            break
+    else:
+        name = 'last' if last else None
+        if last:
+            cursor = 'last=1'
+
+    if name == 'after':
+        rows = queryset.filter(
+            Q(**{f'{field}__gt': key}) | Q(**{field: key, 'id__gt': pk})
+        ).order_by(*forward)
+        reverse = False
+    elif name == 'before':
+        rows = queryset.filter(
+            Q(**{f'{field}__lt': key}) | Q(**{field: key, 'id__lt': pk})
+        ).order_by(*backward)
+        reverse = True
+    elif name == 'last':
+        rows, reverse = queryset.order_by(*backward), True
+    else:
+        rows, reverse = queryset.order_by(*forward), False
+
+    # Лишняя запись показывает, есть ли страница дальше
+    object_list = list(rows[:per_page + 1])
+    more = len(object_list) > per_page
+    object_list = object_list[:per_page]
+    if reverse:
+        object_list.reverse()
+        has_next, has_previous = name == 'before', more
+    else:
+        has_next, has_previous = more, name == 'after'
+
+    return KeysetPage(object_list, count, has_next, has_previous, cursor)
@@ -1,3 +1,9 @@
 # from django.db.models.signals import post_save
 # from django.dispatch import receiver
+from django.dispatch import Signal
 
+# Товары изменены: Product.save(), импорт, остатки с кассы.
+# ids - множество id измененных товаров, categories - id всех затронутых
+# категорий, включая те, из которых товары ушли; если не передано -
+# категории самих товаров
+products_changed = Signal()
@@ -0,0 +1,127 @@
+import logging
+
+from django.db import connection, transaction
+
+from store.importers import BaseImporter, AtolImporter, StockImporter
+from store.models import Category, Product, CategoryStaging, ProductStaging
+
+logger = logging.getLogger(__name__)
+
+# Допустимое уменьшение числа товаров по сравнению с опубликованным каталогом
+MAX_DROP = 0.2
+
+
+class CatalogCheckFailed(Exception):
+    pass
+
+
+class StagedCatalog(BaseImporter):
+    """
+    Blue/green catalog import.
+
+    The ATOL and stock files are imported into empty staging tables while
+    the storefront keeps reading the published catalog. If the new catalog
+    passes the sanity checks, the difference is published to the live
+    tables in one short transaction, so readers see either the old or the
+    new catalog and never a half-imported one. The tables are not renamed:
+    sqlite would rewrite the foreign keys of store_orderproduct to follow
+    the renamed store_product.
+    """
+    summary_keys = ('created', 'updated', 'skipped')
+    product_fields = ('category', 'article', 'title', 'price',
+                      'warehouse1', 'warehouse2')
+    product_values = ('category_id', 'article', 'title', 'price',
+                      'warehouse1', 'warehouse2')
+
+    def __init__(self, max_drop=MAX_DROP, **kwargs):
+        super().__init__(use_manifest=False, **kwargs)
+        self.max_drop = max_drop
+        self.stage_summary = {}
+
+    def prepare(self):
+        """Recreate empty staging tables."""
+        tables = connection.introspection.table_names()
+        with connection.schema_editor() as editor:
+            for model in (ProductStaging, CategoryStaging):
+                if model._meta.db_table in tables:
+                    editor.delete_model(model)
+            for model in (CategoryStaging, ProductStaging):
+                editor.create_model(model)
+
+    def stage(self, atol_file, stock_file=None):
+        options = dict(use_manifest=False, category_model=CategoryStaging,
+                       product_model=ProductStaging)
+        self.stage_summary['atol'] = AtolImporter(**options).run(atol_file)
+        if stock_file:
+            self.stage_summary['stock'] = \
+                StockImporter(**options).run(stock_file)
+
+    def check(self):
+        staged = ProductStaging.objects.count()
+        published = Product.objects.count()
+        if published and staged < published * (1 - self.max_drop):
+            raise CatalogCheckFailed(
+                f'New catalog has {staged} products, published {published}'
+            )
+        if not CategoryStaging.objects.exists() and Category.objects.exists():
+            raise CatalogCheckFailed('New catalog has no categories')
+
+    def publish(self):
+        # order_by(): без сортировки модели и ее JOIN категорий и групп
+        categories = dict(
+            Category.objects.order_by().values_list('id', 'name')
+        )
+        products = {
+            pk: values for pk, *values in Product.objects.order_by()
+            .values_list('id', *self.product_values).iterator()
+        }
+
+        new_categories, changed_categories = [], []
+        for pk, name in CategoryStaging.objects.values_list('id', 'name'):
+            category = Category(id=pk, name=name)
+            if pk not in categories:
+                new_categories.append(category)
+            elif categories[pk] != name:
+                changed_categories.append(category)
+
+        new, changed = [], []
+        for pk, *values in ProductStaging.objects.values_list(
+                'id', *self.product_values).iterator():
+            old = products.get(pk)
+            # Нет в файле остатков - остатки остаются прежними
+            for i in (4, 5):
+                if values[i] is None:
+                    values[i] = old[i] if old else 0
+            product = Product(id=pk, **dict(zip(self.product_values, values)))
+            if old is None:
+                new.append(product)
+            elif old != values:
+                changed.append(product)
+                self.changed_categories.add(old[0])
+            else:
+                self.summary['skipped'] += 1
+                continue
+            self.changed_products.add(pk)
+            self.changed_categories.add(values[0])
+
+        with transaction.atomic():
+            self.bulk_create(Category, new_categories)
+            self.bulk_update(Category, changed_categories, ['name'])
+            self.bulk_create(Product, new)
+            self.bulk_update(Product, changed, self.product_fields)
+
+        self.categories_written = bool(new_categories or changed_categories)
+        self.summary['created'] += len(new_categories) + len(new)
+        self.summary['updated'] += len(changed_categories) + len(changed)
+
+    def run(self, atol_file, stock_file=None):
+        self.prepare()
+        with self.phase('parse'):
+            self.stage(atol_file, stock_file)
+        self.check()
+        with self.phase('write'):
+            self.publish()
+        self.notify()
+        logger.info('Staged import %s: %s', self.stage_summary,
+                    dict(self.summary))
+        return dict(self.summary)
@@ -0,0 +1,86 @@
+from django.db import transaction
+
+from store.importers import BATCH_SIZE, chunked
+from store.models import Product
+from store.signals import products_changed
+from store.utils import get_redis
+
+# Очередь остатков с кассы: хэш id -> "склад1,склад2". Повторные
+# обновления одного товара до записи схлопываются в последнее
+STOCK_QUEUE = 'store:stock:queue'
+STOCK_FLUSH = 'store:stock:flush'
+STOCK_FLUSH_DELAY = 1
+
+
+def parse_stock_updates(items):
+    """
+    Validate [{id, warehouse1, warehouse2}, ...]. Returns {id: (w1, w2)}
+    and the number of rejected items.
+    """
+    updates, rejected = {}, 0
+    for item in items:
+        try:
+            update = tuple(int(item[key]) for key in
+                           ('id', 'warehouse1', 'warehouse2'))
+        except (KeyError, TypeError, ValueError):
+            rejected += 1
+            continue
+        if min(update) < 0:
+            rejected += 1
+            continue
+        pk, w1, w2 = update
+        updates[pk] = (w1, w2)
+    return updates, rejected
+
+
+def queue_stock_updates(updates, restore=False):
+    """
+    Put updates in the queue. Returns True when the caller has to schedule
+    a flush: there is none pending for the next STOCK_FLUSH_DELAY seconds.
+    With restore=True updates newer than the given ones are kept.
+    """
+    r = get_redis()
+    pipe = r.pipeline()
+    for pk, (w1, w2) in updates.items():
+        if restore:
+            pipe.hsetnx(STOCK_QUEUE, pk, f'{w1},{w2}')
+        else:
+            pipe.hset(STOCK_QUEUE, pk, f'{w1},{w2}')
+    pipe.set(STOCK_FLUSH, 1, nx=True, ex=STOCK_FLUSH_DELAY)
+    return bool(pipe.execute()[-1])
+
+
+def drain_stock_updates():
+    r = get_redis()
+    r.delete(STOCK_FLUSH)
+    pipe = r.pipeline()
+    pipe.hgetall(STOCK_QUEUE)
+    pipe.delete(STOCK_QUEUE)
+    items, _ = pipe.execute()
+    return {
+        int(pk): tuple(int(count) for count in value.split(b','))
+        for pk, value in items.items()
+    }
+
+
+def apply_stock_updates(updates):
+    """
+    Write changed counts with one bulk UPDATE per batch. Unknown products
+    are ignored. Returns ids of the changed products.
+    """
+    changed = []
+    for ids in chunked(updates, BATCH_SIZE):
+        for pk, w1, w2 in Product.objects.filter(id__in=ids).order_by() \
+                .values_list('id', 'warehouse1', 'warehouse2'):
+            if (w1, w2) != updates[pk]:
+                w1, w2 = updates[pk]
+                changed.append(Product(id=pk, warehouse1=w1, warehouse2=w2))
+
+    with transaction.atomic():
+        Product.objects.bulk_update(changed, ['warehouse1', 'warehouse2'],
+                                    batch_size=BATCH_SIZE)
+
+    ids = {product.id for product in changed}
+    if ids:
+        products_changed.send(sender=Product, ids=ids)
+    return ids
@@ -1,105 +1,292 @@
 import os
-import re
+import time
+from collections import Counter
 
+from celery import chord
+from celery.result import AsyncResult, GroupResult
 from celery.schedules import crontab
 
 from electron import celery_app
-from xml.etree import ElementTree as ET
 
 from electron.settings import BASE_DIR
-from store.models import Category, Product
-import csv
+from store.images import make_derivatives
+from store.importers import AtolImporter, StockImporter, ImportManifest, \
+    chunked
+from store.models import Product, ProductImage
+from store.signals import products_changed
+from store.staging import StagedCatalog
+from store.stock import drain_stock_updates, apply_stock_updates, \
+    queue_stock_updates, STOCK_FLUSH_DELAY
+from store.typeahead import store_index
+from store.utils import get_redis, RELEASE_LOCK_SCRIPT
+
+ATOL_FILE = 'imported/export_atol.txt'
+STOCK_FILE = 'imported/export.xml'
+# Строк товаров в одной подзадаче импорта
+PIPELINE_CHUNK_SIZE = 2000
+
+# Блокировка импорта во всем кластере. Снимается последним шагом импорта,
+# таймаут - на случай, если импорт упал посередине
+IMPORT_LOCK = 'store:import:lock'
+IMPORT_LOCK_TIMEOUT = 3 * 60 * 60
+# Подзадачи разбирают строки параллельно, а пишут в базу по одной
+IMPORT_WRITE_LOCK = 'store:import:write'
+IMPORT_WRITE_TIMEOUT = 10 * 60
 
 
 @celery_app.on_after_finalize.connect
 def setup_periodic_tasks(sender, **kwargs):
-    sender.add_periodic_task(crontab(minute=0, hour=5), impex())
+    sender.add_periodic_task(crontab(minute=0, hour=5), impex.s(),
+                             name='impex')
+
 
+def acquire_import_lock(token):
+    return bool(get_redis().set(IMPORT_LOCK, token, nx=True,
+                                ex=IMPORT_LOCK_TIMEOUT))
 
-def atol_import(file_name='imported/export_atol.txt'):
 
+def release_import_lock(token):
+    """Release the lock only if it is still held by this import."""
+    if token:
+        get_redis().eval(RELEASE_LOCK_SCRIPT, 1, IMPORT_LOCK, token)
+
+
+def atol_import(file_name=ATOL_FILE):
     file = os.path.join(BASE_DIR, file_name)
+    summary = AtolImporter().run(file)
+    print('ATOL:', summary)
+    return summary
+
+
+def xml_import(file_name=STOCK_FILE):
+    file = os.path.join(BASE_DIR, file_name)
+    summary = StockImporter().run(file)
+    print('XML:', summary)
+    return summary
+
+
+@celery_app.task(bind=True)
+def import_catalog(self, file_name=ATOL_FILE, chunk_size=PIPELINE_CHUNK_SIZE,
+                   stock_file=None, lock=None):
+    """
+    Parse stage of the ATOL import. Categories are written right here, so
+    that every product chunk finds its category; product rows are split
+    into chunks parsed and written in parallel by import_atol_chunk and
+    import_finished aggregates the results. Poll with import_progress().
+    """
+    try:
+        return start_catalog_import(self, file_name, chunk_size,
+                                    stock_file, lock)
+    except Exception:
+        release_import_lock(lock)
+        raise
+
 
-    with open(file, 'r') as f:
-        reader = csv.reader(f, delimiter=';')
-
-        for row in reader:
-            if len(row) < 25:  # строка содержит меньше 25  полей - игнорируем
-                continue
-            try:
-                key = row[0]
-                article = row[25]
-                price = row[4]
-                name = row[2]
-                parent = row[15]
-
-                # Удаляем круглые скобки в начале Наименования
-                name = re.sub(r'^\([^)]+\)\s*', '', name)
-
-                if len(name) < 2:  # Длина наименования меньше 2 - игнорируем
-                    continue
-                if len(article) == 0 and len(price) == 0 and len(row) > 55:
-                    category, created = Category.objects.get_or_create(id=key)
-                    category.name = name
-                    category.save()
-                else:
-                    category = Category.objects.get(id=parent)
-                    product, created = Product.objects.get_or_create(id=key, category=category)
-                    product.title = name
-                    product.article = article
-                    product.price = float(price)
-                    product.save()
-                    # print(product.key, product.title)
-
-            except Exception as e:
-                print(f'{e}\n\t{row}')
-                # logger.error(f'Bad row is {row}\n\t {e}')
-
-
-def xml_import(file_name='imported/export.xml'):
+def start_catalog_import(task, file_name, chunk_size, stock_file, lock):
     file = os.path.join(BASE_DIR, file_name)
+    started = time.time()
+
+    importer = AtolImporter()
+    if importer.file_unchanged(file):
+        finish_import(stock_file, lock)
+        return {'file': file_name, 'unchanged': True}
+
+    task.update_state(state='PROGRESS', meta={'stage': 'parse'})
+    rows = list(importer.select(importer.read(file)))
+    categories, _ = importer.parse(
+        row for row in rows if importer.is_category(row)
+    )
+    importer.load(product_ids=())
+    importer.write_categories(categories)
+    importer.notify()
+    importer.save_manifest(pending=True)
+
+    product_rows = [row for row in rows if not importer.is_category(row)]
+    header = [import_atol_chunk.s(chunk)
+              for chunk in chunked(product_rows, chunk_size)]
+    body = import_finished.s(file_name, started, dict(importer.summary),
+                             stock_file, lock)
+    # Упавшая подзадача не дойдет до import_finished
+    body.on_error(import_failed.s(file_name, lock))
+    if header:
+        result = chord(header)(body)
+        result.parent.save()
+        group_id = result.parent.id
+    else:
+        result = body.delay([])
+        group_id = None
+
+    return {
+        'file': file_name,
+        'started': started,
+        'rows': len(product_rows),
+        'group_id': group_id,
+        'result_id': result.id,
+    }
+
+
+@celery_app.task
+def import_atol_chunk(rows):
+    importer = AtolImporter(use_manifest=False)
+    _, products = importer.parse(rows)
+    importer.load(product_ids=products)
+    with get_redis().lock(IMPORT_WRITE_LOCK, timeout=IMPORT_WRITE_TIMEOUT,
+                          blocking_timeout=IMPORT_WRITE_TIMEOUT):
+        importer.write_products(products)
+        # Витрина, поисковый индекс и числа категорий тоже пишутся в базу
+        importer.notify()
+    return {
+        **importer.summary,
+        'rows': len(rows),
+        'bad_keys': sorted(importer.bad_keys),
+    }
+
+
+@celery_app.task
+def import_finished(results, file_name, started, summary, stock_file=None,
+                    lock=None):
+    """Aggregate chunk results and commit the manifest of the import."""
+    total = Counter(summary)
+    bad_keys = []
+    for result in results:
+        bad_keys += result.pop('bad_keys')
+        result.pop('rows')
+        total.update(result)
+
+    ImportManifest(os.path.join(BASE_DIR, file_name)).commit(discard=bad_keys)
+
+    total['seconds'] = round(time.time() - started, 1)
+    print('ATOL:', dict(total))
+    finish_import(stock_file, lock)
+    return dict(total)
+
+
+@celery_app.task
+def import_failed(request, exc, traceback, file_name, lock=None):
+    """Errback of the chord: forget the pending manifest, free the lock."""
+    print('ATOL import failed:', repr(exc))
+    ImportManifest(os.path.join(BASE_DIR, file_name)).rollback()
+    release_import_lock(lock)
+
+
+def finish_import(stock_file, lock):
+    if stock_file:
+        import_stock.delay(stock_file, lock)
+    else:
+        release_import_lock(lock)
+
+
+@celery_app.task
+def import_stock(file_name=STOCK_FILE, lock=None):
+    try:
+        return xml_import(file_name)
+    finally:
+        release_import_lock(lock)
+
+
+@celery_app.task
+def import_staged(file_name=ATOL_FILE, stock_file=STOCK_FILE, lock=None):
+    """Import into staging tables and publish if the new catalog is sane."""
+    try:
+        summary = StagedCatalog().run(
+            os.path.join(BASE_DIR, file_name),
+            os.path.join(BASE_DIR, stock_file) if stock_file else None,
+        )
+    finally:
+        release_import_lock(lock)
+    print('Staged:', summary)
+    return summary
+
+
+@celery_app.task
+def make_product_images(pk, image_hash):
+    """Resized copies of the product image in every format."""
+    product = Product.objects.filter(pk=pk, image_hash=image_hash).first()
+    if not product or not product.image:
+        return
+    make_derivatives(product.image.path, image_hash,
+                     Product.IMAGE_DERIVATIVES, Product.IMAGE_FORMATS)
+    # Изображение могло смениться, пока шла обработка, а другие товары -
+    # получить это же изображение
+    ProductImage.objects.filter(pk=image_hash).update(ready=True)
+    ids = set(Product.objects.filter(image_hash=image_hash, image_ready=False)
+              .values_list('id', flat=True))
+    if ids:
+        Product.objects.filter(id__in=ids).update(image_ready=True)
+        products_changed.send(sender=Product, ids=ids)
+
+
+@celery_app.task
+def flush_stock_updates():
+    """Apply stock updates queued by StockUpdateView."""
+    updates = drain_stock_updates()
+    try:
+        return len(apply_stock_updates(updates))
+    except Exception:
+        # Вернуть в очередь. Если новых обновлений с запланированной
+        # записью нет, запланировать ее самим, иначе очередь будет ждать
+        # следующего обновления
+        if queue_stock_updates(updates, restore=True):
+            flush_stock_updates.apply_async(countdown=STOCK_FLUSH_DELAY)
+        raise
+
+
+@celery_app.task
+def build_typeahead_index():
+    """Prefix indexes of search suggestions, see store.typeahead.get_index."""
+    store_index()
+
+
+def import_progress(task_id):
+    """Rows done, rows/s and errors of import_catalog started as task_id."""
+    task = AsyncResult(task_id, app=celery_app)
+    if not task.successful():
+        return {'state': task.state, 'info': task.info}
+
+    info = task.result
+    if info.get('unchanged'):
+        return {'state': 'SUCCESS', 'unchanged': True}
+
+    done, failed = [], 0
+    if info['group_id']:
+        group = GroupResult.restore(info['group_id'], app=celery_app)
+        for result in group.results:
+            if result.successful():
+                done.append(result.result)
+            elif result.failed():
+                failed += 1
+
+    rows_done = sum(result['rows'] for result in done)
+    elapsed = time.time() - info['started']
+    finished = AsyncResult(info['result_id'], app=celery_app)
+    return {
+        'state': finished.state if finished.ready() else 'PROGRESS',
+        'rows': info['rows'],
+        'rows_done': rows_done,
+        'rows_per_second': round(rows_done / elapsed) if elapsed else 0,
+        'errors': sum(result['bad'] for result in done) + failed,
+        'summary': finished.result if finished.successful() else None,
+    }
+
+
+@celery_app.task(bind=True)
+def impex(self, staged=False):
     """
-    Parse XML-file with struct:
-        <?xml version="1.0" encoding="windows-1251" ?>
-        <items date="22.02.21">
-        <nom id="36291" name="AUTO MOBIL Очиститель двигателя, 440мл 3-028" art="01013">
-            <prices>
-                <price  name="Розничная" value="113"/>
-            </prices>
-            <whs>
-                <scl name="ЭЛЕКТРОН  ул. Ленина, 28" count="0" />
-                <scl name="Магазин-склад ЭЛЕКТРИКА" count="3" />
-            </whs>
-        </nom>
-        ...
-        </items>
+    Nightly import of the catalog and stock. Only one import runs in the
+    cluster: a trigger while the lock is held is rejected, not queued.
+    With staged=True the catalog is published only after it is fully
+    imported and checked, see store.staging.
     """
-    root = ET.parse(file).getroot()
-    denied = 0
-
-    for node in root.findall('nom'):
-        name = node.get('name')
-        id = node.get('id')
-        # article = node.get('art')
-        whs = []
-        for sub in node.findall('whs/scl'):
-            whs.append(sub.get("count"))
-        # print('\tid:', id, 'name:', name, 'whs:', whs)
-
-        try:
-            product = Product.objects.get(id=id)
-            product.warehouse1 = whs[0]
-            product.warehouse2 = whs[1]
-            product.save()
-        except Exception as e:
-            denied += 1
-            # Товары, которых не оказалось в alol файле (без категорий) отбрасываются
-            print('{e}\n\tid:', id, 'name:', name, 'whs:', whs)
-
-    print('Не найдено по ID:', denied)
-
-
-def impex():
-    # atol_import()
-    xml_import()
-    print('import finished')
+    lock = self.request.id or 'impex'
+    if not acquire_import_lock(lock):
+        print('import is already running, rejected')
+        return {'rejected': True}
+    try:
+        if staged:
+            result = import_staged.delay(lock=lock)
+        else:
+            result = import_catalog.delay(stock_file=STOCK_FILE, lock=lock)
+    except Exception:
+        release_import_lock(lock)
+        raise
+    return {'task_id': result.id}
@@ -0,0 +1,23 @@
+import pytest
+from django.core.cache import cache
+from django.test.utils import override_settings
+
+# Тесты идут без memcached: кэш процесса вместо общего
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tests',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    }
+}
+
+
+@pytest.fixture(scope='session', autouse=True)
+def local_cache():
+    with override_settings(CACHES=TEST_CACHES):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def clear_cache(local_cache):
+    cache.clear()
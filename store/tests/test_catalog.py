@@ -0,0 +1,400 @@
+from importlib import import_module
+
+import pytest
+from django.apps import apps
+from django.db import transaction
+from django.test import Client
+
+from store import fragments
+from store.catalog import get_catalog_tree
+from store.models import Group, Category, Product, PublishedProduct, \
+    SearchTerm
+from store.stock import apply_stock_updates
+from store.utils import bump_catalog_version
+
+
+# transaction=True: версии меняются в on_commit
+@pytest.mark.django_db(transaction=True)
+class TestCatalogCounts:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self):
+        Group.objects.create(id=1, name='Group1')
+        Group.objects.create(id=2, name='Group2')
+        Category.objects.create(id=10, name='Category10')
+        Category.objects.create(id=20, name='Category20', parent_id=2)
+        for pk in (100, 101, 102):
+            Product.objects.create(id=pk, category_id=10, article=str(pk),
+                                   title=f'Product{pk}')
+
+    def counts(self, model, pk):
+        return model.objects.values_list(
+            'product_count', 'in_stock_count').get(pk=pk)
+
+    def test_counts_follow_saves_and_stock(self):
+        assert self.counts(Category, 10) == (3, 0)
+        assert self.counts(Group, 1) == (3, 0)
+
+        apply_stock_updates({100: (1, 0), 101: (0, 2)})
+        assert self.counts(Category, 10) == (3, 2)
+
+        product = Product.objects.get(id=100)
+        product.category_id = 20
+        product.save()
+        assert self.counts(Category, 10) == (2, 1)
+        assert self.counts(Category, 20) == (1, 1)
+        assert self.counts(Group, 1) == (2, 1)
+        assert self.counts(Group, 2) == (1, 1)
+
+        Product.objects.get(id=101).delete()
+        assert self.counts(Group, 1) == (1, 0)
+
+    def test_navigation_without_catalog_queries(
+            self, django_assert_max_num_queries):
+        Category.objects.bulk_create(
+            Category(id=pk, name=f'Category{pk}', parent_id=2)
+            for pk in range(21, 221)
+        )
+        bump_catalog_version()
+        client = Client()
+        for url in ('/', '/group/2/', '/category/10/'):
+            client.get(url)
+            # Прогретый кэш: запросы только сессии, корзины и товаров
+            with django_assert_max_num_queries(6) as captured:
+                response = client.get(url)
+            assert response.status_code == 200
+            assert not [query for query in captured.captured_queries
+                        if 'store_category' in query['sql']
+                        or 'store_group' in query['sql']]
+        assert 'Category220' in client.get('/group/2/').content.decode()
+
+    def test_tree_follows_catalog_changes(self):
+        client = Client()
+        assert 'Group2' in client.get('/').content.decode()
+        Group.objects.filter(id=2).update(name='Renamed')
+        # update() в обход сигналов - дерево прежнее
+        assert 'Renamed' not in client.get('/').content.decode()
+
+        group = Group.objects.get(id=2)
+        group.save()
+        assert 'Renamed' in client.get('/').content.decode()
+
+        Product.objects.create(id=200, category_id=20, article='200',
+                               title='Product200', warehouse1=3)
+        tree = get_catalog_tree()
+        assert tree['categories'][20]['in_stock_count'] == 1
+        assert client.get('/category/20/').status_code == 200
+        assert client.get('/category/999/').status_code == 404
+
+
+# transaction=True: версии меняются в on_commit
+@pytest.mark.django_db(transaction=True)
+class TestProductFragments:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self, monkeypatch):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10', parent_id=1)
+        for pk in (100, 101, 102):
+            Product.objects.create(id=pk, category_id=10, article=str(pk),
+                                   title=f'Product{pk}', price=10)
+        self.rendered = []
+        render = fragments.render_to_string
+
+        def counting_render(template_name, context):
+            self.rendered.append(context['product'].pk)
+            return render(template_name, context)
+
+        monkeypatch.setattr(fragments, 'render_to_string', counting_render)
+
+    def test_only_changed_products_are_rendered(self):
+        client = Client()
+        client.get('/category/10/')
+        assert sorted(self.rendered) == [100, 101, 102]
+
+        self.rendered.clear()
+        client.get('/category/10/')
+        assert self.rendered == []
+
+        apply_stock_updates({101: (4, 0)})
+        self.rendered.clear()
+        content = client.get('/category/10/').content.decode()
+        assert self.rendered == [101]
+        assert content.count('Нет в наличии') == 2
+
+        # Плитка кэшируется отдельно от строк таблицы
+        self.rendered.clear()
+        client.get('/category/10/?view=tiles')
+        assert sorted(self.rendered) == [100, 101, 102]
+
+
+# transaction=True: версии меняются в on_commit
+@pytest.mark.django_db(transaction=True)
+class TestPageCache:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10', parent_id=1)
+        Product.objects.create(id=100, category_id=10, article='100',
+                               title='Product100', price=10, warehouse1=5)
+
+    def test_anonymous_pages_are_served_from_cache(
+            self, django_assert_num_queries):
+        client = Client()
+        for url in ('/', '/group/1/', '/category/10/', '/product/100/'):
+            first = client.get(url)
+            with django_assert_num_queries(0):
+                second = client.get(url)
+            assert second.status_code == 200
+            assert second.content == first.content
+            assert b'cart-count' in second.content
+
+        # Новый остаток меняет версию каталога
+        apply_stock_updates({100: (0, 0)})
+        assert 'Нет в наличии' in client.get('/category/10/').content.decode()
+
+    def test_cart_summary(self):
+        client = Client()
+        client.get('/add-to-cart/100/')
+        response = client.get('/cart/summary/').json()
+        assert response['count'] == 1
+        assert 'Product100' in response['messages'][0]
+        assert client.get('/cart/summary/').json()['messages'] == []
+
+    def test_change_keeps_pages_of_other_products(
+            self, django_assert_num_queries):
+        Category.objects.create(id=20, name='Category20', parent_id=1)
+        Product.objects.create(id=200, category_id=20, article='200',
+                               title='Product200', price=10, warehouse1=5)
+        client = Client()
+        urls = ('/', '/group/1/', '/category/10/', '/category/20/',
+                '/product/100/', '/product/200/')
+        for url in urls:
+            client.get(url)
+
+        # Цена без изменения чисел: общие страницы остаются в кэше
+        product = Product.objects.get(id=200)
+        product.price = 20
+        product.save()
+        for url in ('/', '/group/1/', '/category/10/', '/product/100/'):
+            with django_assert_num_queries(0):
+                client.get(url)
+        assert '20' in client.get('/product/200/').content.decode()
+
+        apply_stock_updates({200: (0, 0)})
+        for url in ('/category/10/', '/product/100/'):
+            with django_assert_num_queries(0):
+                client.get(url)
+        assert '1 / 2' in client.get('/').content.decode()
+
+    def test_session_pages_are_not_cached(self):
+        client = Client()
+        client.get('/category/10/?view=tiles')
+        assert client.cookies.get('sessionid')
+        response = client.get('/category/10/')
+        assert b'tm-popular-item' in response.content
+        assert not getattr(response.wsgi_request, 'page_cache', False)
+
+
+# transaction=True: версии меняются в on_commit
+@pytest.mark.django_db(transaction=True)
+class TestConditionalGet:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10', parent_id=1)
+        Category.objects.create(id=20, name='Category20', parent_id=1)
+        Product.objects.create(id=100, category_id=10, article='100',
+                               title='Product100', price=10, warehouse1=5)
+        Product.objects.create(id=200, category_id=20, article='200',
+                               title='Product200', price=10, warehouse1=5)
+
+    def revalidate(self, client, url):
+        etag = client.get(url)['ETag']
+        return client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_not_modified_without_queries(self, django_assert_num_queries):
+        client = Client()
+        for url in ('/group/1/', '/category/10/', '/product/100/'):
+            etag = client.get(url)['ETag']
+            with django_assert_num_queries(0):
+                response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            assert response.status_code == 304
+
+    def test_validators_are_scoped(self):
+        client = Client()
+        etags = {url: client.get(url)['ETag'] for url in (
+            '/group/1/', '/category/10/', '/category/20/',
+            '/product/100/', '/product/200/')}
+
+        apply_stock_updates({200: (0, 0)})
+        changed = {url for url, etag in etags.items()
+                   if client.get(url, HTTP_IF_NONE_MATCH=etag).status_code
+                   == 200}
+        assert changed == {'/group/1/', '/category/20/', '/product/200/'}
+
+        # Имя категории есть в навигации всех страниц
+        Category.objects.get(id=10).save()
+        assert self.revalidate(client, '/product/100/').status_code == 304
+        etag = etags['/product/100/']
+        assert client.get('/product/100/',
+                          HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+    def test_validators_change_after_commit(self):
+        client = Client()
+        etag = client.get('/product/100/')['ETag']
+        with transaction.atomic():
+            Product.objects.filter(id=100).get().save()
+            # Страница, собранная до коммита, не закэширована под новой
+            # версией
+            assert client.get('/product/100/',
+                              HTTP_IF_NONE_MATCH=etag).status_code == 304
+        assert client.get('/product/100/',
+                          HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+    def test_no_validators_with_session(self):
+        client = Client()
+        client.get('/category/10/?view=tiles')
+        assert not client.get('/category/10/').has_header('ETag')
+
+
+# transaction=True: версии меняются в on_commit
+@pytest.mark.django_db(transaction=True)
+class TestPublishedCatalog:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10', parent_id=1)
+        for pk in (100, 101):
+            Product.objects.create(id=pk, category_id=10, article=str(pk),
+                                   title=f'Product{pk}', price=10)
+
+    def published(self, pk):
+        return PublishedProduct.objects.filter(pk=pk).values(
+            'title', 'quantity', 'in_stock', 'category_name',
+            'group_name').first()
+
+    def test_projection_follows_changes(self):
+        assert self.published(100) == {
+            'title': 'Product100', 'quantity': 0, 'in_stock': False,
+            'category_name': 'Category10', 'group_name': 'Group1'}
+
+        apply_stock_updates({100: (2, 3)})
+        assert self.published(100)['quantity'] == 5
+        assert self.published(100)['in_stock']
+
+        category = Category.objects.get(id=10)
+        category.name = 'Renamed'
+        category.save()
+        group = Group.objects.get(id=1)
+        group.name = 'Group renamed'
+        group.save()
+        assert self.published(101)['category_name'] == 'Renamed'
+        assert self.published(101)['group_name'] == 'Group renamed'
+
+        product = Product.objects.get(id=101)
+        product.display = False
+        product.save()
+        assert self.published(101) is None
+        assert Category.objects.values_list(
+            'product_count', flat=True).get(id=10) == 1
+
+        Product.objects.get(id=100).delete()
+        assert not PublishedProduct.objects.exists()
+
+        PublishedProduct.objects.rebuild()
+        assert list(PublishedProduct.objects.values_list('id', flat=True)) \
+            == []
+
+    def test_pages_read_one_table(self, django_assert_max_num_queries):
+        client = Client()
+        with django_assert_max_num_queries(10) as captured:
+            assert client.get('/category/10/').status_code == 200
+            assert client.get('/product/100/').status_code == 200
+        sql = [query['sql'] for query in captured.captured_queries]
+        assert not [query for query in sql if '"store_product"' in query]
+        published = [query for query in sql
+                     if '"store_publishedproduct"' in query]
+        assert len(published) == 2
+        assert not [query for query in published if 'JOIN' in query]
+
+        Product.objects.filter(id=100).update(display=False)
+        PublishedProduct.objects.rebuild()
+        assert client.get('/product/100/').status_code == 404
+
+    def test_migration_fills_projection(self):
+        migration = import_module(
+            'store.migrations.0014_fill_published_catalog')
+        fields = [field.name for field in PublishedProduct._meta.fields]
+        refreshed = list(PublishedProduct.objects.values_list(*fields))
+        terms = sorted(SearchTerm.objects.values_list('product_id', 'term'))
+        SearchTerm.objects.all().delete()
+        PublishedProduct.objects.all().delete()
+
+        migration.fill_published_catalog(apps, None)
+        assert list(PublishedProduct.objects.values_list(*fields)) == \
+            refreshed
+        assert sorted(SearchTerm.objects.values_list(
+            'product_id', 'term')) == terms
+
+
+@pytest.mark.django_db
+class TestCartSummary:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10', parent_id=1)
+        for pk in (100, 101):
+            Product.objects.create(id=pk, category_id=10, article=str(pk),
+                                   title=f'Product{pk}', price=10,
+                                   warehouse1=5)
+
+    def cart_queries(self, captured):
+        return [query for query in captured.captured_queries
+                if '"store_order"' in query['sql']
+                or '"store_customer"' in query['sql']]
+
+    def badge(self, response):
+        content = response.content.decode()
+        start = content.index('id="cart-count">') + len('id="cart-count">')
+        return content[start:content.index('<', start)]
+
+    def test_catalog_pages_without_cart_queries(
+            self, django_assert_max_num_queries):
+        client = Client()
+        client.get('/add-to-cart/100/')
+        client.get('/add-to-cart/101/')
+        # Настройка вида дает сессию: страницы без общего кэша
+        client.get('/category/10/?view=tiles')
+        for url in ('/', '/group/1/', '/category/10/', '/product/100/',
+                    '/cart/summary/'):
+            with django_assert_max_num_queries(10) as captured:
+                response = client.get(url)
+            assert response.status_code == 200
+            assert not self.cart_queries(captured)
+        assert response.json()['count'] == 2
+        assert self.badge(client.get('/product/100/')) == '2'
+
+    def test_cart_views_update_summary(self):
+        client = Client()
+        assert self.badge(client.get('/cart/')) == '0'
+        client.get('/add-to-cart/100/')
+        assert client.get('/cart/summary/').json()['count'] == 1
+        client.get('/add-to-cart/101/')
+        assert client.get('/cart/summary/').json()['count'] == 2
+        client.get('/remove-from-cart/100/')
+        assert self.badge(client.get('/cart/')) == '1'
+        client.post('/change-qty/101/', {'qty': 0})
+        assert client.get('/cart/summary/').json()['count'] == 0
+
+
+def test_cache_is_shared_between_processes():
+    # Celery меняет версии каталога для веб-процессов через общий кэш
+    from electron import settings as project_settings
+    backend = project_settings.CACHES['default']['BACKEND']
+    assert 'locmem' not in backend
+    assert 'dummy' not in backend
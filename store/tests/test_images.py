@@ -0,0 +1,245 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.http import Http404
+
+from store import images
+from store.models import Group, Category, Product, ProductImage, \
+    PublishedProduct, NO_IMAGE_URL
+from store.tasks import make_product_images
+from store.views import MediaView, ImageVariantView
+
+
+def upload(color, name='photo.jpg'):
+    content = io.BytesIO()
+    Image.new('RGB', (600, 800), color).save(content, 'JPEG')
+    return SimpleUploadedFile(name, content.getvalue(),
+                              content_type='image/jpeg')
+
+
+# transaction=True: on_commit выполняется сразу
+@pytest.mark.django_db(transaction=True)
+class TestProductImages:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self, settings, tmp_path, monkeypatch):
+        settings.MEDIA_ROOT = str(tmp_path)
+        monkeypatch.setattr('store.images.MEDIA_ROOT', str(tmp_path))
+        monkeypatch.setattr('store.utils.MEDIA_ROOT', str(tmp_path))
+        monkeypatch.setattr('electron.settings.MEDIA_ROOT', str(tmp_path))
+        self.media = tmp_path
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10')
+        self.product = Product.objects.create(id=100, category_id=10,
+                                              article='A', title='Product')
+
+    def test_derivatives_after_task(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(make_product_images, 'delay',
+                            lambda *args: calls.append(args))
+        self.product.image = upload('red')
+        self.product.save()
+
+        product = Product.objects.get(id=100)
+        assert not product.image_ready
+        assert product.image_name() == NO_IMAGE_URL
+        assert calls == [(100, product.image_hash)]
+
+        make_product_images(*calls[0])
+        product.refresh_from_db()
+        assert product.image_ready
+        first_hash = product.image_hash
+        assert product.image_name() == f'/media/card/{first_hash}.jpg'
+        for name in ('card/{}.jpg', 'card/{}.webp', 'thumb/{}.webp'):
+            assert os.path.exists(self.media / name.format(first_hash))
+
+        # Тот же файл повторно - обработки нет
+        product.image = upload('red')
+        product.save()
+        assert len(calls) == 1
+        assert Product.objects.get(id=100).image_ready
+
+        # Новое изображение - новый адрес
+        product.image = upload('blue')
+        product.save()
+        make_product_images(*calls[-1])
+        product.refresh_from_db()
+        assert product.image_hash != first_hash
+        assert product.image_name() == f'/media/card/{product.image_hash}.jpg'
+
+    def test_immutable_media(self, rf):
+        Product.objects.filter(id=100).update(image='10_100.jpg')
+        assert Product.objects.get(id=100).image_name() == \
+            '/media/card/10_100.jpg'
+
+        image_hash = '0' * 32
+        for name in (f'card/{image_hash}.jpg', 'card/10_100.jpg'):
+            os.makedirs(self.media / 'card', exist_ok=True)
+            with open(self.media / name, 'wb') as f:
+                f.write(upload('red').read())
+        path = f'card/{image_hash}.jpg'
+        response = MediaView.as_view()(rf.get(f'/media/{path}'), path=path)
+        assert 'immutable' in response['Cache-Control']
+        path = 'card/10_100.jpg'
+        response = MediaView.as_view()(rf.get(f'/media/{path}'), path=path)
+        assert not response.has_header('Cache-Control')
+
+    def test_import_images_command(self, tmp_path_factory):
+        photos = tmp_path_factory.mktemp('photos')
+        Product.objects.create(id=101, category_id=10, article='3-028',
+                               title='Product')
+        for name, color in (('100.jpg', 'red'), ('3-028.png', 'blue'),
+                            ('unknown.jpg', 'green')):
+            with open(photos / name, 'wb') as f:
+                f.write(upload(color).read())
+
+        out = io.StringIO()
+        call_command('import_images', str(photos), workers=2, stdout=out)
+        assert 'Attached: 2, already done: 0' in out.getvalue()
+        product = Product.objects.get(id=101)
+        assert product.image.name == f'{product.image_hash}.png'
+        assert product.image_ready
+        assert os.path.exists(
+            self.media / 'card' / f'{product.image_hash}.webp')
+
+        out = io.StringIO()
+        call_command('import_images', str(photos), workers=2, stdout=out)
+        assert 'Attached: 0, already done: 2' in out.getvalue()
+
+    def test_duplicate_upload_is_shared(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(make_product_images, 'delay',
+                            lambda *args: calls.append(args))
+        other = Product.objects.create(id=101, category_id=10, article='B',
+                                       title='Other')
+        self.product.image = upload('red')
+        self.product.save()
+        make_product_images(*calls[0])
+
+        # То же изображение у другого товара - без обработки
+        other.image = upload('red', 'other.jpg')
+        other.save()
+        other.refresh_from_db()
+        assert len(calls) == 1
+        assert other.image_ready
+        assert other.image.name == self.product.image.name
+        stored = ProductImage.objects.get()
+        assert stored.refcount == 2
+
+        other.image = upload('blue')
+        other.save()
+        self.product.image = None
+        self.product.save()
+        assert not ProductImage.objects.filter(pk=stored.pk).exists()
+        assert not os.path.exists(self.media / stored.name)
+        assert not os.path.exists(
+            self.media / 'card' / f'{stored.image_hash}.jpg')
+
+    def test_dedupe_images_command(self):
+        Product.objects.create(id=101, category_id=10, article='B',
+                               title='Other')
+        for pk in (100, 101):
+            with open(self.media / f'10_{pk}.jpg', 'wb') as f:
+                f.write(upload('red').read())
+        os.makedirs(self.media / 'card')
+        with open(self.media / 'card' / '10_100.jpg', 'wb') as f:
+            f.write(upload('red').read())
+        for pk in (100, 101):
+            Product.objects.filter(id=pk).update(image=f'10_{pk}.jpg')
+
+        out = io.StringIO()
+        call_command('dedupe_images', stdout=out)
+        assert 'unique images: 1' in out.getvalue()
+        assert 'Deleted 3 files' in out.getvalue()
+        stored = ProductImage.objects.get()
+        assert stored.refcount == 2
+        assert set(Product.objects.values_list('image', flat=True)) == \
+            {stored.name}
+        assert sorted(os.listdir(self.media)) == \
+            sorted(['big', 'card', stored.name, 'thumb'])
+        # Витрина видит новые имена файлов
+        assert set(PublishedProduct.objects.values_list(
+            'thumb_url', flat=True)) == \
+            {Product.objects.get(id=100).thumb_url()}
+
+    def test_image_variant(self, rf, monkeypatch, django_assert_num_queries):
+        class FakeRedis:
+            keys = {}
+
+            def set(self, key, value, nx=False, ex=None):
+                return self.keys.setdefault(key, value) == value
+
+            def eval(self, script, numkeys, key, token):
+                if self.keys.get(key) == token:
+                    del self.keys[key]
+
+        monkeypatch.setattr('store.images.get_redis', FakeRedis)
+        monkeypatch.setattr(make_product_images, 'delay', lambda *args: None)
+        monkeypatch.setattr('electron.settings.DEBUG', False)
+        self.product.image = upload('red')
+        self.product.save()
+        image_hash = self.product.image_hash
+        view = ImageVariantView.as_view()
+
+        response = view(rf.get('/'), image_hash=image_hash, width=600,
+                        height=800, ext='webp')
+        assert response.status_code == 200
+        assert response['X-Accel-Redirect'] == \
+            f'/media/img/{image_hash}/600x800.webp'
+        assert 'immutable' in response['Cache-Control']
+        with Image.open(self.media / 'img' / image_hash / '600x800.webp') \
+                as img:
+            assert img.size == (600, 800)
+        assert not FakeRedis.keys
+
+        # Готовый вариант - без обращения к базе и пулу
+        resize_pool = images.resize_pool
+        monkeypatch.setattr('store.images.resize_pool', None)
+        with django_assert_num_queries(0):
+            view(rf.get('/'), image_hash=image_hash, width=600, height=800,
+                 ext='webp')
+
+        for width, height, ext in ((601, 800, 'webp'), (600, 800, 'gif')):
+            with pytest.raises(Http404):
+                view(rf.get('/'), image_hash=image_hash, width=width,
+                     height=height, ext=ext)
+        with pytest.raises(Http404):
+            view(rf.get('/'), image_hash='0' * 32, width=600, height=800,
+                 ext='jpg')
+
+        # Поврежденный оригинал - 503, а не ошибка сервера
+        monkeypatch.setattr('store.images.resize_pool', resize_pool)
+        with open(self.media / self.product.image.name, 'wb') as f:
+            f.write(b'not an image')
+        response = view(rf.get('/'), image_hash=image_hash, width=300,
+                        height=400, ext='jpg')
+        assert response.status_code == 503
+        assert os.listdir(self.media / 'img' / image_hash) == \
+            ['600x800.webp']
+        assert not FakeRedis.keys
+
+        # Варианты удаляются вместе с изображением
+        self.product.image = None
+        self.product.save()
+        assert not os.path.exists(self.media / 'img' / image_hash)
+
+    def test_delete_releases_image(self, monkeypatch):
+        monkeypatch.setattr(make_product_images, 'delay', lambda *args: None)
+        other = Product.objects.create(id=101, category_id=10, article='B',
+                                       title='Other')
+        for product in (self.product, other):
+            product.image = upload('red')
+            product.save()
+        stored = ProductImage.objects.get()
+        assert stored.refcount == 2
+
+        other.delete()
+        assert ProductImage.objects.get().refcount == 1
+        # Каскадно вместе с категорией
+        Category.objects.get(id=10).delete()
+        assert not ProductImage.objects.exists()
+        assert not os.path.exists(self.media / stored.name)
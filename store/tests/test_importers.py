@@ -0,0 +1,244 @@
+import contextlib
+import io
+import os
+
+import pytest
+from decimal import Decimal
+from django.core.management import call_command
+
+from store.importers import AtolImporter, StockImporter, ImportManifest, \
+    chunked
+from store.models import Group, Category, Product
+from store.tasks import import_atol_chunk, import_finished, import_failed, \
+    IMPORT_WRITE_LOCK
+from store.utils import scope_versions
+
+
+def atol_row(key, name, price='', article='', parent='', length=26):
+    row = [''] * length
+    row[0], row[2], row[4], row[15], row[25] = \
+        str(key), name, price, str(parent), article
+    return ';'.join(row)
+
+
+@pytest.fixture
+def atol_file(tmp_path):
+    def write(*rows):
+        file = tmp_path / 'export_atol.txt'
+        file.write_text('\n'.join(rows) + '\n')
+        return str(file)
+    return write
+
+
+@pytest.mark.django_db
+class TestAtolImporter:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10')
+        Product.objects.create(id=100, category_id=10, article='A-100',
+                               title='Product100', price=5)
+
+    def test_create_update_skip(self, atol_file):
+        file = atol_file(
+            atol_row(20, 'Category20', length=60),
+            atol_row(100, 'Product100', price='5.00', article='A-100',
+                     parent=10),
+            atol_row(101, '(new) Product101', price='7,5', article='A-101',
+                     parent=20),
+            atol_row(102, 'Product102', price='1', article='A-102',
+                     parent=999),
+            'short;row',
+        )
+        summary = AtolImporter().run(file)
+
+        assert summary == {'created': 2, 'updated': 0,
+                           'skipped': 2, 'bad': 1}
+        product = Product.objects.get(id=101)
+        assert product.title == 'Product101'
+        assert product.category_id == 20
+        assert product.price == Decimal('7.50')
+        assert Category.objects.get(id=20).product_count == 1
+        assert Group.objects.get(id=1).product_count == 2
+
+    def test_changed_rows_are_updated(self, atol_file):
+        file = atol_file(
+            atol_row(10, 'Renamed', length=60),
+            atol_row(100, 'Product100', price='6', article='A-100',
+                     parent=10),
+        )
+        importer = AtolImporter()
+        summary = importer.run(file)
+
+        assert summary['updated'] == 2
+        assert importer.changed_products == {100}
+        assert Category.objects.get(id=10).name == 'Renamed'
+        assert Product.objects.get(id=100).price == Decimal('6.00')
+
+    def test_manifest_skips_unchanged_rows(self, atol_file):
+        rows = [
+            atol_row(100, 'Product100', price='5', article='A-100', parent=10),
+            atol_row(101, 'Product101', price='7', article='A-101', parent=10),
+        ]
+        file = atol_file(*rows)
+        assert AtolImporter().run(file)['created'] == 1
+
+        # Файл не изменился - пропускается целиком
+        assert AtolImporter().run(file) == {'created': 0, 'updated': 0,
+                                            'skipped': 0, 'bad': 0}
+
+        rows[1] = atol_row(101, 'Product101', price='8', article='A-101',
+                           parent=10)
+        file = atol_file(*rows)
+        importer = AtolImporter()
+        assert importer.run(file) == {'created': 0, 'updated': 1,
+                                      'skipped': 1, 'bad': 0}
+        assert importer.changed_products == {101}
+
+
+STOCK_XML = '''<?xml version="1.0" encoding="windows-1251" ?>
+<items date="22.02.21">
+{}
+</items>
+'''
+
+STOCK_NOM = '''<nom id="{}" name="Product" art="01013">
+    <prices><price name="Розничная" value="113"/></prices>
+    <whs>
+        <scl name="ЭЛЕКТРОН" count="{}" />
+        <scl name="ЭЛЕКТРИКА" count="{}" />
+    </whs>
+</nom>'''
+
+
+@pytest.mark.django_db
+class TestStockImporter:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10')
+        for pk in (100, 101):
+            Product.objects.create(id=pk, category_id=10, article=str(pk),
+                                   title=f'Product{pk}', warehouse1=1)
+
+    def test_only_changed_counts_are_written(self, tmp_path, monkeypatch,
+                                             django_assert_num_queries):
+        file = tmp_path / 'export.xml'
+        file.write_text(STOCK_XML.format('\n'.join([
+            STOCK_NOM.format(100, 1, 0),
+            STOCK_NOM.format(101, 2, 3),
+            STOCK_NOM.format(999, 1, 1),
+            STOCK_NOM.format(102, 'x', 1),
+        ])), encoding='cp1251')
+
+        importer = StockImporter()
+        notify = importer.notify
+        monkeypatch.setattr(importer, 'notify', lambda: None)
+        # select остатков + одна транзакция с одним UPDATE
+        with django_assert_num_queries(4):
+            summary = importer.run(str(file))
+        notify()
+        assert Category.objects.get(id=10).in_stock_count == 2
+
+        assert summary == {'updated': 1, 'skipped': 1,
+                           'missing': 1, 'bad': 1}
+        assert importer.changed_products == {101}
+        product = Product.objects.get(id=101)
+        assert (product.warehouse1, product.warehouse2) == (2, 3)
+
+
+@pytest.mark.django_db
+class TestImportPipeline:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self, monkeypatch):
+        class FakeRedis:
+            def lock(self, name, **kwargs):
+                return contextlib.nullcontext()
+
+        monkeypatch.setattr('store.tasks.get_redis', FakeRedis)
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10')
+
+    def test_chunk_notifies_under_write_lock(self, atol_file, monkeypatch):
+        held = []
+
+        class RecordingRedis:
+            @contextlib.contextmanager
+            def lock(self, name, **kwargs):
+                held.append(name)
+                yield
+                held.remove(name)
+
+        notified = []
+        monkeypatch.setattr('store.tasks.get_redis', RecordingRedis)
+        monkeypatch.setattr(AtolImporter, 'notify',
+                            lambda importer: notified.append(list(held)))
+        file = atol_file(
+            atol_row(101, 'Product101', price='1', article='A', parent=10))
+        rows = list(AtolImporter().select(AtolImporter().read(file)))
+        import_atol_chunk(rows)
+        assert notified == [[IMPORT_WRITE_LOCK]]
+
+    def test_chunks_and_aggregation(self, atol_file):
+        file = atol_file(
+            atol_row(101, 'Product101', price='1', article='A', parent=10),
+            atol_row(102, 'Product102', price='2', article='B', parent=10),
+            atol_row(103, 'Product103', price='3', article='C', parent=99),
+        )
+        importer = AtolImporter()
+        assert not importer.file_unchanged(file)
+        rows = list(importer.select(importer.read(file)))
+        importer.save_manifest(pending=True)
+
+        results = [import_atol_chunk(chunk) for chunk in chunked(rows, 2)]
+        assert [result['bad_keys'] for result in results] == [[], ['103']]
+
+        summary = import_finished(results, file, 0, {'skipped': 0})
+        assert summary['created'] == 2
+        assert summary['bad'] == 1
+        assert ImportManifest(file).rows.keys() == {'101', '102'}
+
+    def test_failed_chunk_releases_lock(self, atol_file, monkeypatch):
+        released = []
+        monkeypatch.setattr('store.tasks.release_import_lock',
+                            released.append)
+        file = atol_file(atol_row(101, 'Product101', price='1', article='A',
+                                  parent=10))
+        importer = AtolImporter()
+        importer.file_unchanged(file)
+        list(importer.select(importer.read(file)))
+        importer.save_manifest(pending=True)
+
+        import_failed(None, Exception('database is locked'), None, file,
+                      lock='token')
+        assert released == ['token']
+        assert not os.path.exists(f'{file}.manifest.pending')
+        assert not os.path.exists(f'{file}.manifest')
+
+
+# transaction=True: версии каталога меняются в on_commit
+@pytest.mark.django_db(transaction=True)
+class TestImportBenchmark:
+
+    def test_generated_dry_run(self, tmp_path):
+        files = [tmp_path / 'first.txt', tmp_path / 'second.txt']
+        version = scope_versions(['tree', 'counts'])
+        for file in files:
+            out = io.StringIO()
+            call_command('import_benchmark', 'atol', str(file),
+                         generate=300, stdout=out)
+            assert "Summary: {'created': 300" in out.getvalue()
+            assert 'rows/s' in out.getvalue()
+            assert '  notify: ' in out.getvalue()
+        # Один seed - один и тот же файл, прогон откатывается вместе с
+        # версиями кэша
+        assert files[0].read_bytes() == files[1].read_bytes()
+        assert not Product.objects.exists()
+        assert scope_versions(['tree', 'counts']) == version
+
+        call_command('import_benchmark', 'atol', str(files[1]),
+                     generate=300, seed=1, stdout=io.StringIO())
+        assert files[0].read_bytes() != files[1].read_bytes()
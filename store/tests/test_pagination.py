@@ -0,0 +1,63 @@
+import pytest
+from django.test import Client
+
+from store.models import Group, Category, Product
+from store.pagination import keyset_page
+
+
+@pytest.mark.django_db
+class TestKeysetPagination:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10')
+        # Одинаковые наименования различаются по id
+        for pk, title in enumerate('AABCDDDEFG', start=1):
+            Product.objects.create(id=pk, category_id=10, article=str(pk),
+                                   title=title)
+        self.queryset = Product.objects.filter(category_id=10)
+
+    def pages(self, **cursor):
+        page = keyset_page(self.queryset, 'title', 3, 10, **cursor)
+        return [product.id for product in page], page
+
+    def test_walk_forward_and_back(self):
+        ids, page = self.pages()
+        assert ids == [1, 2, 3]
+        assert page.has_next() and not page.has_previous()
+
+        walked = ids
+        for _ in range(10):
+            if not page.has_next():
+                break
+            ids, page = self.pages(after=page.next_cursor)
+            walked += ids
+        assert walked == list(range(1, 11))
+        assert page.cursor == 'after=9'
+
+        ids, page = self.pages(before=5)
+        assert ids == [2, 3, 4]
+        assert page.has_next() and page.has_previous()
+
+        ids, page = self.pages(last=True)
+        assert ids == [8, 9, 10]
+        assert page.has_previous() and not page.has_next()
+
+    def test_page_costs_no_offset_or_count(self, django_assert_num_queries):
+        with django_assert_num_queries(2) as captured:
+            self.pages(after=6)
+        sql = captured.captured_queries[-1]['sql']
+        assert 'OFFSET' not in sql and 'COUNT' not in sql
+
+        # Неверный курсор и товар другой категории - первая страница
+        Category.objects.create(id=11, name='Category11')
+        Product.objects.create(id=99, category_id=11, article='99',
+                               title='B')
+        assert self.pages(after='x')[0] == [1, 2, 3]
+        assert self.pages(after=99)[0] == [1, 2, 3]
+
+    def test_legacy_page_redirects(self):
+        response = Client().get('/category/10/?page=7&view=list')
+        assert response.status_code == 301
+        assert response['Location'] == '/category/10/?view=list'
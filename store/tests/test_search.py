@@ -0,0 +1,233 @@
+import pytest
+
+from store import typeahead
+from store.models import Group, Category, Product, PublishedProduct, \
+    SearchTerm
+from store.stock import apply_stock_updates
+from store.tasks import build_typeahead_index
+from store.utils import query_terms, article_key
+from store.views import ProductSearchView
+
+
+@pytest.fixture
+def catalog(db):
+    Group.objects.create(id=1, name='Group1')
+    Category.objects.create(id=10, name='Category10', parent_id=1)
+    for pk, article, title in (
+            (100, 'VVG-3x2.5', 'Кабель медный ВВГ'),
+            (101, 'PV-1', 'Провод для кабеля и розеток'),
+            (102, 'R-16', 'Розетка двойная'),
+            (103, 'K-2', 'Кабель алюминиевый')):
+        Product.objects.create(id=pk, category_id=10, article=article,
+                               title=title)
+
+
+def search(query):
+    return list(PublishedProduct.objects.search(query_terms(query))
+                .values_list('id', flat=True))
+
+
+@pytest.mark.django_db
+class TestSearchIndex:
+
+    def test_word_forms_and_articles(self, catalog):
+        assert search('кабеля') == [103, 100, 101]
+        assert search('розеткам') == [101, 102]
+        assert search('vvg 3x2,5') == [100]
+        assert search('ВВГ') == [100]
+        assert search('') == []
+
+    def test_rank_by_matches_then_stock(self, catalog):
+        assert search('медный кабель')[0] == 100
+        apply_stock_updates({100: (1, 0)})
+        assert search('кабель') == [100, 103, 101]
+
+    def test_index_follows_changes(self, catalog):
+        product = Product.objects.get(id=102)
+        product.title = 'Выключатель'
+        product.save()
+        assert search('розетка') == [101]
+        assert search('выключателя') == [102]
+
+        product.display = False
+        product.save()
+        assert search('выключатель') == []
+        assert not SearchTerm.objects.filter(product_id=102).exists()
+
+        Product.objects.get(id=100).delete()
+        assert search('медный') == []
+
+
+@pytest.mark.django_db
+def test_search_page(catalog, client):
+    content = client.get('/search/', {'p': 'кабеля'}).content.decode()
+    assert 'Кабель медный ВВГ' in content
+    assert 'Розетка двойная' not in content
+
+
+# transaction=True: версии меняются в on_commit
+@pytest.mark.django_db(transaction=True)
+class TestSearchPage:
+
+    @pytest.fixture(autouse=True)
+    def small_pages(self, monkeypatch, catalog):
+        monkeypatch.setattr(ProductSearchView, 'paginate_by', 2)
+
+    def queries(self, captured, table):
+        return [query for query in captured.captured_queries
+                if f'"{table}"' in query['sql']]
+
+    def test_pages(self, client):
+        first = client.get('/search/', {'p': 'кабель'})
+        assert [product.id for product in first.context['page_obj']] \
+            == [103, 100]
+        assert 'page=2' in first.content.decode()
+        second = client.get('/search/', {'p': 'кабель', 'page': 2})
+        assert [product.id for product in second.context['page_obj']] \
+            == [101]
+        assert client.get('/search/', {'p': 'кабель', 'page': 9}) \
+            .status_code == 404
+
+    def test_empty_query_runs_no_search(
+            self, client, django_assert_max_num_queries):
+        for params in ({}, {'p': ''}, {'p': ' ,. '}):
+            with django_assert_max_num_queries(5) as captured:
+                assert client.get('/search/', params).status_code == 200
+            assert not self.queries(captured, 'store_searchterm')
+            assert not self.queries(captured, 'store_publishedproduct')
+
+    def test_results_are_cached_per_catalog_version(
+            self, client, django_assert_max_num_queries):
+        client.get('/search/', {'p': 'Кабеля медные'})
+        with django_assert_max_num_queries(5) as captured:
+            response = client.get('/search/', {'p': 'медный  кабель'})
+        assert not self.queries(captured, 'store_searchterm')
+        assert [product.id for product in response.context['page_obj']] \
+            == [100, 103]
+
+        Product.objects.create(id=104, category_id=10, article='K-4',
+                               title='Кабель медный гибкий')
+        response = client.get('/search/', {'p': 'медный кабель'})
+        assert [product.id for product in response.context['page_obj']] \
+            == [100, 104]
+
+
+# transaction=True: версии меняются в on_commit
+@pytest.mark.django_db(transaction=True)
+class TestTypeahead:
+
+    @pytest.fixture(autouse=True)
+    def fresh_index(self, monkeypatch, catalog):
+        class FakeRedis:
+            keys = {}
+
+            def get(self, key):
+                return self.keys.get(key)
+
+            def set(self, key, value, nx=False, ex=None):
+                if nx and key in self.keys:
+                    return False
+                self.keys[key] = value
+                return True
+
+            def mset(self, mapping):
+                self.keys.update(
+                    (key, value if isinstance(value, bytes)
+                     else value.encode()) for key, value in mapping.items())
+
+        self.redis = FakeRedis()
+        self.redis.keys = {}
+        self.scheduled = []
+        monkeypatch.setattr('store.typeahead.get_redis', lambda: self.redis)
+        monkeypatch.setattr(build_typeahead_index, 'delay',
+                            lambda: self.scheduled.append(True))
+        monkeypatch.setattr(typeahead, '_index', None)
+
+    def build(self):
+        # Задача в воркере; TYPEAHEAD_BUILD истек
+        build_typeahead_index()
+        self.redis.keys.pop(typeahead.TYPEAHEAD_BUILD, None)
+        self.scheduled.clear()
+
+    def titles(self, client, query):
+        found = client.get('/search/suggest/', {'p': query}).json()
+        return [product['title'] for product in found['products']]
+
+    def test_index_is_built_outside_request(
+            self, client, django_assert_num_queries):
+        with django_assert_num_queries(0):
+            assert self.titles(client, 'кабель') == []
+            assert self.titles(client, 'кабель') == []
+        assert self.scheduled == [True]
+        self.build()
+        assert len(self.titles(client, 'кабель')) == 2
+        assert not self.scheduled
+
+    def test_prefixes_without_queries(self, client, django_assert_num_queries):
+        self.build()
+        self.titles(client, 'ка')
+        with django_assert_num_queries(0):
+            response = client.get('/search/suggest/', {'p': 'Кабель м'})
+        assert 'public' in response['Cache-Control']
+        assert [product['id'] for product in response.json()['products']] \
+            == [100]
+        assert self.titles(client, 'ка') == [
+            'Кабель алюминиевый', 'Кабель медный ВВГ',
+            'Провод для кабеля и розеток']
+        assert self.titles(client, 'мед') == ['Кабель медный ВВГ']
+        assert self.titles(client, 'медн каб') == ['Кабель медный ВВГ']
+        assert self.titles(client, 'кабел р') == [
+            'Провод для кабеля и розеток']
+        assert self.titles(client, 'vvg-3') == ['Кабель медный ВВГ']
+        assert self.titles(client, 'k') == []
+        found = client.get('/search/suggest/', {'p': 'categ'}).json()
+        assert found['categories'][0]['url'] == '/category/10/'
+
+    def test_in_stock_first_and_refresh(self, client):
+        self.build()
+        apply_stock_updates({100: (1, 0)})
+        # До новой сборки подсказки из прежнего индекса
+        assert self.titles(client, 'кабель ')[0] == 'Кабель алюминиевый'
+        assert self.scheduled == [True]
+        self.build()
+        assert self.titles(client, 'кабель ')[0] == 'Кабель медный ВВГ'
+        Product.objects.create(id=104, category_id=10, article='K-4',
+                               title='Кабель гибкий')
+        self.build()
+        assert 'Кабель гибкий' in self.titles(client, 'кабель')
+
+
+@pytest.mark.django_db
+class TestArticleLookup:
+
+    @pytest.fixture(autouse=True)
+    def articles(self, catalog):
+        for pk, article in ((110, '3-028'), (111, 'AB-1042.O'),
+                            (112, '3-029'), (113, '7-028')):
+            Product.objects.create(id=pk, category_id=10, article=article,
+                                   title=f'Товар {pk}')
+
+    def find(self, text):
+        return PublishedProduct.objects.find_article(text)
+
+    def test_article_key(self):
+        assert article_key('З-028') == article_key('3 028') == '3028'
+        assert article_key('АВ-1042.о') == article_key('ab1042-0') \
+            == 'ab10420'
+
+    def test_exact_key_first(self):
+        for text in ('3-028', '3028', 'З-028', ' 3.028 '):
+            assert self.find(text) == [110]
+        assert self.find('АВ1042О') == [111]
+        assert PublishedProduct.objects.filter(pk=110).values_list(
+            'article_key', flat=True).get() == '3028'
+
+    def test_typos(self):
+        assert self.find('3-0288') == [110]
+        assert self.find('3-02') == [110, 112]
+        assert self.find('AB-1024.0') == [111]
+        assert self.find('9-999') == []
+
+    def test_search_page_puts_article_first(self, client):
+        response = client.get('/search/', {'p': 'З-028'})
+        assert response.context['page_obj'][0].id == 110
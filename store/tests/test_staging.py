@@ -0,0 +1,56 @@
+import pytest
+
+from store.models import Group, Category, Product
+from store.staging import StagedCatalog, CatalogCheckFailed
+from store.tests.test_importers import atol_row, STOCK_XML, STOCK_NOM
+
+
+@pytest.fixture
+def export_files(tmp_path):
+    def write(atol_rows, noms=()):
+        atol = tmp_path / 'export_atol.txt'
+        atol.write_text('\n'.join(atol_rows) + '\n')
+        stock = tmp_path / 'export.xml'
+        stock.write_text(STOCK_XML.format('\n'.join(noms)), encoding='cp1251')
+        return str(atol), str(stock)
+    return write
+
+
+@pytest.mark.django_db(transaction=True)
+class TestStagedCatalog:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10')
+        for pk in (100, 101, 102):
+            Product.objects.create(id=pk, category_id=10, article=str(pk),
+                                   title=f'Product{pk}', price=1,
+                                   warehouse1=1)
+
+    def test_publish_difference(self, export_files):
+        files = export_files([
+            atol_row(10, 'Category10', length=60),
+            atol_row(100, 'Product100', price='1', article='100', parent=10),
+            atol_row(101, 'Renamed', price='1', article='101', parent=10),
+            atol_row(102, 'Product102', price='1', article='102', parent=10),
+            atol_row(103, 'Product103', price='2', article='103', parent=10),
+        ], [STOCK_NOM.format(100, 1, 0), STOCK_NOM.format(103, 4, 0)])
+
+        catalog = StagedCatalog()
+        assert catalog.run(*files) == {'created': 1, 'updated': 1,
+                                       'skipped': 2}
+        assert catalog.changed_products == {101, 103}
+        assert Product.objects.get(id=101).title == 'Renamed'
+        # Товара нет в файле остатков - остатки не меняются
+        assert Product.objects.get(id=102).warehouse1 == 1
+        assert Product.objects.get(id=103).warehouse1 == 4
+
+    def test_row_count_drop_cancels_publish(self, export_files):
+        files = export_files([
+            atol_row(10, 'Category10', length=60),
+            atol_row(100, 'Renamed', price='1', article='100', parent=10),
+        ])
+        with pytest.raises(CatalogCheckFailed):
+            StagedCatalog().run(*files)
+        assert Product.objects.get(id=100).title == 'Product100'
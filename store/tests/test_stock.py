@@ -0,0 +1,86 @@
+import pytest
+from django.urls import reverse
+
+from store.models import Group, Category, Product
+from store.signals import products_changed
+from store.stock import parse_stock_updates, apply_stock_updates, \
+    STOCK_FLUSH_DELAY
+from store.tasks import flush_stock_updates
+
+
+def test_parse_stock_updates():
+    updates, rejected = parse_stock_updates([
+        {'id': 1, 'warehouse1': 2, 'warehouse2': '3'},
+        {'id': 1, 'warehouse1': 4, 'warehouse2': 5},
+        {'id': 2, 'warehouse1': -1, 'warehouse2': 0},
+        {'id': 3},
+    ])
+    assert updates == {1: (4, 5)}
+    assert rejected == 2
+
+
+@pytest.mark.django_db
+class TestStockUpdates:
+
+    @pytest.fixture(autouse=True)
+    def setup_catalog(self):
+        Group.objects.create(id=1, name='Group1')
+        Category.objects.create(id=10, name='Category10')
+        for pk in (100, 101):
+            Product.objects.create(id=pk, category_id=10, article=str(pk),
+                                   title=f'Product{pk}', warehouse1=1)
+
+    def test_apply_changed_only(self):
+        received = []
+
+        def receiver(sender, ids, **kwargs):
+            received.append(ids)
+
+        products_changed.connect(receiver)
+        try:
+            changed = apply_stock_updates({100: (1, 0), 101: (0, 2),
+                                           999: (1, 1)})
+        finally:
+            products_changed.disconnect(receiver)
+
+        assert changed == {101}
+        assert received == [{101}]
+        product = Product.objects.get(id=101)
+        assert (product.warehouse1, product.warehouse2) == (0, 2)
+
+    def test_endpoint_requires_token(self, client, monkeypatch):
+        monkeypatch.setattr('electron.settings.POS_API_TOKEN', 'secret')
+        url = reverse('stock_update')
+        response = client.post(url, '[]', content_type='application/json')
+        assert response.status_code == 403
+
+        response = client.post(url, '{', content_type='application/json',
+                               HTTP_AUTHORIZATION='Token secret')
+        assert response.status_code == 400
+
+    def test_failed_flush_is_rescheduled(self, monkeypatch):
+        restored, scheduled = [], []
+        monkeypatch.setattr('store.tasks.drain_stock_updates',
+                            lambda: {100: (3, 0)})
+
+        def failing_apply(updates):
+            raise RuntimeError('database is locked')
+
+        def queue(updates, restore=False):
+            restored.append((updates, restore))
+            return not scheduled
+
+        monkeypatch.setattr('store.tasks.apply_stock_updates', failing_apply)
+        monkeypatch.setattr('store.tasks.queue_stock_updates', queue)
+        monkeypatch.setattr(flush_stock_updates, 'apply_async',
+                            lambda **options: scheduled.append(options))
+
+        with pytest.raises(RuntimeError):
+            flush_stock_updates()
+        assert restored == [({100: (3, 0)}, True)]
+        assert scheduled == [{'countdown': STOCK_FLUSH_DELAY}]
+
+        # Запись уже запланирована новыми обновлениями
+        with pytest.raises(RuntimeError):
+            flush_stock_updates()
+        assert len(scheduled) == 1
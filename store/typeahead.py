@@ -0,0 +1,146 @@
+import pickle
+from bisect import bisect_left
+
+from django.urls import reverse
+
+from store.catalog import get_catalog_tree
+from store.models import PublishedProduct
+from store.utils import catalog_version, article_key, get_redis
+
+TYPEAHEAD_LIMIT = 10
+TYPEAHEAD_MIN_LENGTH = 2
+TYPEAHEAD_SCAN = 500
+# Остатки меняют версию каталога часто: индекс строится не чаще
+TYPEAHEAD_MAX_AGE = 60
+# Индекс строит задача build_typeahead_index, веб-процессы его только
+# читают
+TYPEAHEAD_INDEX = 'store:typeahead:index'
+TYPEAHEAD_VERSION = 'store:typeahead:version'
+TYPEAHEAD_BUILD = 'store:typeahead:build'
+
+
+def name_words(name):
+    return name.lower().replace('ё', 'е').split()
+
+
+class PrefixIndex:
+    """
+    Sorted words of item names and article keys, one entry per word with
+    the position and rank of its item.
+    """
+
+    def __init__(self, entries, items):
+        entries.sort()
+        self.keys = [key for key, rank, position in entries]
+        self.entries = [(rank, position) for key, rank, position in entries]
+        self.items = items
+
+    def find(self, words, limit):
+        """
+        Best ranked items with a word starting with each of the words.
+        The longest one is looked up, among its first TYPEAHEAD_SCAN keys:
+        a short prefix does not walk the whole catalog. Names of the found
+        items are checked for the others.
+        """
+        prefix = max(words, key=len)
+        found = {}
+        i = bisect_left(self.keys, prefix)
+        end = min(i + TYPEAHEAD_SCAN, len(self.keys))
+        while i < end and self.keys[i].startswith(prefix):
+            rank, position = self.entries[i]
+            found.setdefault(position, rank)
+            i += 1
+        if len(words) > 1:
+            found = {
+                position: rank for position, rank in found.items()
+                if all(any(word.startswith(query) for word in
+                           name_words(self.items[position][1]))
+                       for query in words)
+            }
+        best = sorted(found, key=found.get)[:limit]
+        return [self.items[position] for position in best]
+
+
+def build_index():
+    products, entries = [], []
+    for pk, title, article, in_stock in PublishedProduct.objects.order_by() \
+            .values_list('id', 'title', 'article', 'in_stock').iterator():
+        position = len(products)
+        products.append((pk, title, article))
+        rank = (not in_stock, title)
+        keys = set(name_words(title))
+        keys.add(article_key(article))
+        entries.extend((key, rank, position) for key in keys if key)
+
+    categories, category_entries = [], []
+    for category in get_catalog_tree()['categories'].values():
+        position = len(categories)
+        categories.append((category['id'], category['name'], category['url']))
+        category_entries.extend(
+            (key, (-category['in_stock_count'], category['name']), position)
+            for key in set(name_words(category['name'])))
+
+    return PrefixIndex(entries, products), \
+        PrefixIndex(category_entries, categories)
+
+
+def store_index():
+    """Build the indexes and share them with web processes, see get_index."""
+    version = catalog_version()
+    indexes = build_index()
+    get_redis().mset({
+        TYPEAHEAD_INDEX: pickle.dumps(indexes, pickle.HIGHEST_PROTOCOL),
+        TYPEAHEAD_VERSION: repr(version),
+    })
+
+
+_index = None
+
+
+def get_index():
+    """
+    Prefix indexes of products and categories built by store_index, loaded
+    once per process and version. An index older than the catalog is
+    rebuilt by build_typeahead_index at most every TYPEAHEAD_MAX_AGE, the
+    request keeps answering from the old one.
+    """
+    global _index
+    r = get_redis()
+    version = r.get(TYPEAHEAD_VERSION)
+    if (version is None or float(version) != catalog_version()) \
+            and r.set(TYPEAHEAD_BUILD, 1, nx=True, ex=TYPEAHEAD_MAX_AGE):
+        from store.tasks import build_typeahead_index
+        build_typeahead_index.delay()
+    if _index is None or _index[0] != version:
+        stored = version and r.get(TYPEAHEAD_INDEX)
+        if not stored:
+            # Первый запуск: подсказок нет, пока задача не построит индекс
+            return PrefixIndex([], []), PrefixIndex([], [])
+        _index = (version, pickle.loads(stored))
+    return _index[1]
+
+
+def suggest(query, limit=TYPEAHEAD_LIMIT):
+    """Products and categories with words starting with the query words."""
+    words = name_words(query)
+    if len(' '.join(words)) < TYPEAHEAD_MIN_LENGTH:
+        return {'products': [], 'categories': []}
+    products, categories = get_index()
+
+    found = products.find(words, limit)
+    key = article_key(query)
+    if key and [key] != words and len(found) < limit:
+        found += [item for item in products.find([key], limit)
+                  if item not in found][:limit - len(found)]
+
+    return {
+        'products': [
+            {'id': pk, 'title': title, 'article': article,
+             'url': reverse('product_detail', kwargs={'pk': pk})}
+            for pk, title, article in found
+        ],
+        'categories': [
+            {'id': pk, 'name': name, 'url': url}
+            for pk, name, url in categories.find(words, limit)
+        ],
+    }
@@ -5,25 +5,36 @@ from store.views import (
     ProductDetailView,
     GroupDetailView,
     CartView,
+    CartSummaryView,
     AddToCartView,
     DeleteFromCartView,
     ChangeQTYView,
     MakeOrderView,
     ProductSearchView,
+    SearchSuggestView,
     ProductListView,
     EmailView,
+    StockUpdateView,
+    ImageVariantView,
 )
 
 urlpatterns = [
     path('', GroupListView.as_view(), name='group_list'),
     path('search/', ProductSearchView.as_view(), name='search'),
+    path('search/suggest/', SearchSuggestView.as_view(), name='search_suggest'),
     path('product/<int:pk>/', ProductDetailView.as_view(), name='product_detail'),
     path('group/<int:pk>/', GroupDetailView.as_view(), name='group_detail'),
     path('category/<int:pk>/', ProductListView.as_view(), name='category_detail'),
     path('cart/', CartView.as_view(), name='cart'),
+    path('cart/summary/', CartSummaryView.as_view(), name='cart_summary'),
     path('add-to-cart/<int:pk>/', AddToCartView.as_view(), name='add_to_cart'),
     path('remove-from-cart/<int:pk>/', DeleteFromCartView.as_view(), name='delete_from_cart'),
     path('change-qty/<int:pk>/', ChangeQTYView.as_view(), name='change_qty'),
     path('checkout/', MakeOrderView.as_view(), name='checkout'),
+    path('api/stock/', StockUpdateView.as_view(), name='stock_update'),
+    # Готовые варианты nginx отдает сам, в Django только первый запрос:
+    #   location /img/ { root <MEDIA_ROOT>; try_files $uri @django; }
+    path('img/<slug:image_hash>/<int:width>x<int:height>.<slug:ext>',
+         ImageVariantView.as_view(), name='image_variant'),
     # path('order_email/<int:order>/', EmailView.as_view(), name='order_email'),
 ]
@@ -1,18 +1,168 @@
 import os
 import random
+import re
 import string
-from electron.settings import MEDIA_ROOT
+import time
+from functools import lru_cache
+
 import pymorphy2
+import redis
+from django.core.cache import cache
+from django.db import transaction
+
+from electron.settings import MEDIA_ROOT, CELERY_BROKER_URL
 
 morph = pymorphy2.MorphAnalyzer()
 
+WORD = re.compile(r'[^\W_]+')
+# Длина слова в поисковом индексе, см. SearchTerm
+TERM_LENGTH = 100
+# Похожие буквы и цифры артикулов: кириллица -> латиница, O -> 0, З -> 3
+LOOKALIKES = str.maketrans('авекмнорстухзo', 'abekmh0pctyx30')
+# Триграммы артикулов в SearchTerm, слова запроса так не начинаются
+TRIGRAM = '~'
+
+# Снять блокировку, только если она еще принадлежит владельцу токена
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
 
 def path_and_rename(instance, filename):
-    ext = filename.split('.')[-1]
-    filename = f'{instance.category.pk}_{instance.pk}.{ext}'
-    os.remove(os.path.join(MEDIA_ROOT, filename))
+    # Оригинал хранится один раз на содержимое, см. ProductImage
+    ext = filename.split('.')[-1].lower()
+    filename = f'{instance.image_hash}.{ext}'
+    if os.path.exists(os.path.join(MEDIA_ROOT, filename)):
+        os.remove(os.path.join(MEDIA_ROOT, filename))
     return f'{filename}'
 
 
 def get_random_session():
     return ''.join(random.choices(string.ascii_letters + string.digits, k=36))
+
+
+# Версия каталога: время последнего изменения групп, категорий или товаров
+CATALOG_VERSION = 'catalog:version'
+
+_redis = None
+
+
+def get_redis():
+    """One client and connection pool per process."""
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(CELERY_BROKER_URL)
+    return _redis
+
+
+def catalog_version():
+    version = cache.get(CATALOG_VERSION)
+    if version is None:
+        version = time.time()
+        cache.add(CATALOG_VERSION, version, None)
+        version = cache.get(CATALOG_VERSION, version)
+    return version
+
+
+def bump_catalog_version(scopes=()):
+    """
+    Invalidate everything cached under the catalog version and under the
+    versions of the given scopes, see scope_versions. Both are bumped
+    after the commit of the current transaction.
+    """
+    transaction.on_commit(
+        lambda: cache.set(CATALOG_VERSION, time.time(), None))
+    bump_scope_versions(scopes)
+
+
+def scope_versions(scopes):
+    """
+    Versions of parts of the catalog: 'product:<id>', 'category:<id>',
+    'group:<id>', 'tree' for names of groups and categories and 'counts'
+    for their product counts. A scope
+    without a version (never asked, changed or evicted from the cache)
+    gets a new one, so nothing older is served under it.
+    """
+    keys = {scope: f'{CATALOG_VERSION}:{scope}' for scope in scopes}
+    cached = cache.get_many(keys.values())
+    versions, missing = {}, {}
+    for scope, key in keys.items():
+        if key in cached:
+            versions[scope] = cached[key]
+        else:
+            versions[scope] = missing[key] = time.time()
+    if missing:
+        cache.set_many(missing, None)
+    return versions
+
+
+def bump_scope_versions(scopes):
+    # До коммита другой запрос закэшировал бы старые строки под новой
+    # версией
+    keys = [f'{CATALOG_VERSION}:{scope}' for scope in scopes]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+@lru_cache(maxsize=100000)
+def lemma(word):
+    """Normal form of a word: 'кабеля' -> 'кабель'."""
+    if not word.isalpha():
+        return word
+    return morph.parse(word)[0].normal_form.replace('ё', 'е')
+
+
+def lemmas(text):
+    words = WORD.findall(text.lower().replace('ё', 'е'))
+    return {lemma(word)[:TERM_LENGTH] for word in words}
+
+
+def article_key(article):
+    """
+    Article without case, separators and look-alike letters:
+    'AB-12.3' -> 'ab123', 'З-028' -> '3028'.
+    """
+    key = ''.join(WORD.findall(article.lower().replace('ё', 'е')))
+    return key.translate(LOOKALIKES)[:TERM_LENGTH]
+
+
+def article_trigrams(key):
+    padded = f'^{key}$'
+    return {f'{TRIGRAM}{padded[i:i + 3]}' for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b):
+    """Levenshtein distance: insertions, deletions and replacements."""
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def search_terms(title, article):
+    """Terms of a product in the search index, see SearchTerm."""
+    terms = lemmas(title)
+    key = article_key(article)
+    if key:
+        terms.add(key)
+        terms.update(article_trigrams(key))
+    return terms
+
+
+def query_terms(query):
+    """
+    Normalized search query: the set of its index terms. The article key
+    of the whole query is searched for a single word or a query with
+    digits, so word order of other queries does not matter.
+    """
+    terms = lemmas(query)
+    if len(terms) == 1 or any(char.isdigit() for char in query):
+        terms.add(article_key(query))
+    return terms - {''}
@@ -1,25 +1,48 @@
+import hmac
+import json
+import os
 from datetime import datetime, timedelta
 
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.contrib.auth import login, authenticate
+from django.core.cache import cache
 from django.db import transaction
 from django.db.models import Q
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, JsonResponse, \
+    Http404, HttpResponsePermanentRedirect
 from django.shortcuts import render
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import never_cache, cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.static import serve
 from django.views.generic import DetailView, View, ListView
 from django.core.mail import send_mail
+from django.template.defaultfilters import floatformat
 from django.template.loader import render_to_string
 
 from electron import settings
 from .forms import LoginForm, RegistrationForm
-from .mixins import CartMixin
-from .models import Group, Category, Customer, OrderProduct, \
-    Product, Order, Article
+from .catalog import get_catalog_tree, search_product_ids
+from .fragments import render_products
+from .images import IMMUTABLE_NAME, IMMUTABLE_CACHE_CONTROL, \
+    VARIANT_SIZES, VARIANT_FORMATS, variant_name, get_variant, media_path
+from .mixins import CartMixin, PageCacheMixin, get_cart_summary, \
+    cart_summary_key
+from .pagination import keyset_page
+from .typeahead import TYPEAHEAD_MAX_AGE, suggest
+from .models import Group, Customer, OrderProduct, \
+    Product, Order, Article, ProductImage, PublishedProduct
+from .stock import parse_stock_updates, queue_stock_updates, \
+    STOCK_FLUSH_DELAY
+from .tasks import flush_stock_updates
 from .utils import get_random_session
 
 
+PAGER_SIZES = ('20', '50', '200', '500')
+
+
 class MyQ(Q):
     default = 'OR'
 
@@ -28,112 +51,166 @@ class WelcomeView(CartMixin, View):
 
     def get(self, request, *args, **kwargs):
         context = {
-            'order': self.order,
             'articles': self.articles,
             'page_role': 'welcome',
         }
         return render(request, 'welcome.html', context)
 
 
-class GroupListView(CartMixin, View):
+class GroupListView(PageCacheMixin, View):
     model = Group
+    page_scopes = ('tree', 'counts')
 
     def get(self, request, *args, **kwargs):
-        groups = Group.objects.all().order_by('name')
+        catalog = get_catalog_tree()
 
         context = {
-            'groups': groups,
-            'order': self.order,
+            'catalog': catalog,
+            'groups': catalog['groups'],
             'articles': self.articles,
         }
         return render(request, 'group_list.html', context)
 
 
-class ProductDetailView(CartMixin, DetailView):
-    model = Product
+class ProductDetailView(PageCacheMixin, DetailView):
+    # Витрина: скрытые товары не показываются
+    model = PublishedProduct
+    context_object_name = 'product'
+    page_scopes = ('tree', 'product:{pk}')
     template_name = 'item_detail.html'
 
     def get_context_data(self, **kwargs):
 
         context = super().get_context_data(**kwargs)
 
-        context['order'] = self.order
         context['articles'] = self.articles
 
         return context
 
 
-class ProductListView(CartMixin, ListView):
-    model = Product
+class ProductListView(PageCacheMixin, ListView):
+    model = PublishedProduct
     template_name = 'product_list.html'
     paginate_by = 50
+    page_scopes = ('tree', 'category:{pk}')
+
+    def get(self, request, *args, **kwargs):
+        # Постраничный вывод по ключу: старые ссылки ?page=N ведут на
+        # первую страницу, чтобы обход по номерам не стоил OFFSET
+        if 'page' in request.GET:
+            query = request.GET.copy()
+            del query['page']
+            url = request.path + (f'?{query.urlencode()}' if query else '')
+            return HttpResponsePermanentRedirect(url)
+        return super().get(request, *args, **kwargs)
 
     def get_queryset(self):
         pk = self.kwargs.get('pk')
-        object_list = Product.objects.filter(category_id=pk)
+        self.catalog = get_catalog_tree()
+        self.category = self.catalog['categories'].get(pk)
+        if self.category is None:
+            raise Http404
+        object_list = PublishedProduct.objects.filter(category_id=pk)
 
         return object_list
 
+    def paginate_queryset(self, queryset, page_size):
+        # Число товаров хранится в категории, COUNT(*) не нужен
+        page = keyset_page(
+            queryset, 'title', int(page_size), self.category['product_count'],
+            after=self.request.GET.get('after'),
+            before=self.request.GET.get('before'),
+            last='last' in self.request.GET,
+        )
+        return None, page, page.object_list, page.has_other_pages()
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['order'] = self.order
         context['articles'] = self.articles
-        context['category'] = Category.objects.get(pk=self.kwargs.get('pk'))
-
-        view = self.request.GET.get('view') or self.request.session.get('view')
-        if view:
+        context['catalog'] = self.catalog
+        context['category'] = self.category
+        context['group'] = self.category['group']
+
+        # Сессия пишется только при смене настройки: без cookie сессии
+        # страница общая для всех и попадает в кэш, см. PageCacheMixin
+        view = self.request.GET.get('view')
+        if view and view != self.request.session.get('view'):
             self.request.session['view'] = view
+        view = view or self.request.session.get('view')
         context['view'] = view
+        # Карточки товаров из кэша фрагментов, см. store.fragments
+        context['products_html'] = render_products(
+            context['page_obj'], 'card' if view == 'tiles' else 'row')
 
-        pager = self.paginate_by or self.request.session.get('pager')
-        context['pager'] = pager
-        if pager:
-            self.request.session['pager'] = pager
+        context['pager'] = self.paginate_by
 
         return context
 
     def get_paginate_by(self, queryset):
-        pager = self.request.GET.get('pager') or self.request.session.get('pager')
-        if pager:
-            self.request.session['pager'] = pager
-            self.paginate_by = pager
+        pager = self.request.GET.get('pager')
+        if pager in PAGER_SIZES:
+            if pager != self.request.session.get('pager'):
+                self.request.session['pager'] = pager
+        else:
+            pager = self.request.session.get('pager')
+        if pager not in PAGER_SIZES:
+            return self.paginate_by
+        self.paginate_by = pager
         return pager
 
 
-class GroupDetailView(CartMixin, DetailView):
-    model = Group
-    queryset = Group.objects.all()
-    context_object_name = 'group'
-    template_name = 'category_list.html'
+class GroupDetailView(PageCacheMixin, View):
+    page_scopes = ('tree', 'group:{pk}')
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        group = self.get_object()
-        context['order'] = self.order
-        context['group_name'] = group.name
-        context['categories'] = Category.objects.filter(
-            parent=group
-        ).order_by('name')
-        context['articles'] = self.articles
-        return context
+    def get(self, request, *args, **kwargs):
+        catalog = get_catalog_tree()
+        group = catalog['group_by_id'].get(kwargs.get('pk'))
+        if group is None:
+            raise Http404
+
+        context = {
+            'catalog': catalog,
+            'group': group,
+            'group_name': group['name'],
+            'categories': group['categories'],
+            'articles': self.articles,
+        }
+        return render(request, 'category_list.html', context)
 
 
 class ProductSearchView(CartMixin, ListView):
-    model = Product
+    model = PublishedProduct
     template_name = 'product_search.html'
+    paginate_by = 50
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['order'] = self.order
         context['articles'] = self.articles
+        context['query'] = self.request.GET.get('p') or ''
+        context['products_html'] = render_products(
+            context['page_obj'], 'card')
         return context
 
     def get_queryset(self):
-        query = self.request.GET.get('p')
-        object_list = Product.objects.filter(
-            Q(title__icontains=query) | Q(article__icontains=query)
-        )
-        return object_list
+        # Ids найденных товаров из кэша результатов; пустой запрос - []
+        return search_product_ids(self.request.GET.get('p') or '')
+
+    def paginate_queryset(self, queryset, page_size):
+        # Из таблицы читаются только товары страницы
+        paginator, page, ids, is_paginated = super().paginate_queryset(
+            queryset, page_size)
+        products = PublishedProduct.objects.in_bulk(ids)
+        page.object_list = [products[pk] for pk in ids if pk in products]
+        return paginator, page, page.object_list, is_paginated
+
+
+@method_decorator(cache_control(public=True, max_age=TYPEAHEAD_MAX_AGE),
+                  name='dispatch')
+class SearchSuggestView(View):
+    """Typeahead of the search box, from the prefix index in memory."""
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(suggest(request.GET.get('p') or ''))
 
 
 class AddToCartView(CartMixin, View):
@@ -154,6 +231,10 @@ class AddToCartView(CartMixin, View):
             old_carts = Order.carts.filter(
                 created_at__lte=datetime.now() - timedelta(days=2)
             )
+            cache.delete_many([
+                cart_summary_key(old_session) for old_session in
+                old_carts.values_list('owner__session', flat=True)
+            ])
             old_carts.delete()
 
         product = Product.objects.get(pk=kwargs['pk'])
@@ -190,6 +271,7 @@ class AddToCartView(CartMixin, View):
                     message
                 )
             self.order.save()
+        self.cart_changed(session)
 
         response = HttpResponseRedirect(f"/store/cart/")
         response.set_cookie(key='customersession', value=session)
@@ -207,6 +289,7 @@ class DeleteFromCartView(CartMixin, View):
         self.order.products.remove(order_product)
         order_product.delete()
         self.order.save()
+        self.cart_changed()
         messages.add_message(request, messages.INFO,
                              f'{order_product.product.image_thumb()} '
                              f' Удалено из корзины: <b>{order_product}</b>')
@@ -249,6 +332,7 @@ class ChangeQTYView(CartMixin, View):
                 f'Удалено из корзины: <b>{order_product}</b>'
             )
         self.order.save()
+        self.cart_changed()
         return HttpResponseRedirect('/store/cart/')
 
 
@@ -271,12 +355,27 @@ class CartView(CartMixin, View):
         return render(request, 'cart.html', context)
 
 
+@method_decorator(never_cache, name='dispatch')
+class CartSummaryView(View):
+    """Cart badge and messages of the pages from PageCacheMixin."""
+
+    def get(self, request, *args, **kwargs):
+        cart = get_cart_summary(request.COOKIES.get('customersession'))
+        return JsonResponse({
+            'count': cart['count'],
+            'total': floatformat(cart['total'], 0) if cart['total'] else '',
+            'messages': [str(message) for message in
+                         messages.get_messages(request)],
+        })
+
+
 class CheckoutView(CartMixin, View):
 
     def post(self, request, *args, **kwargs):
 
         self.order.delivery_type = request.POST.get('delivery_type')
         self.order.save()
+        self.cart_changed()
 
         context = {
             'order': self.order,
@@ -298,7 +397,6 @@ class MakeOrderView(LoginRequiredMixin, CartMixin, View):
         customer = Customer.objects.get(user=user.id, session=session)
         if not customer.confirmed:
             context = {
-                'order': self.order,
                 'articles': self.articles,
             }
             return render(request, 'registration_confirmation_required.html', context=context)
@@ -307,6 +405,8 @@ class MakeOrderView(LoginRequiredMixin, CartMixin, View):
 
         order.status = 'new'
         order.save()
+        # Корзина стала заказом
+        cache.delete(cart_summary_key(session))
 
         messages.add_message(
             request,
@@ -373,7 +473,6 @@ class LoginView(CartMixin, View):
 
         context = {
             'form': form,
-            'order': self.order,
             'page_role': 'login',
             'articles': self.articles,
         }
@@ -405,7 +504,6 @@ class LoginView(CartMixin, View):
 
         context = {
             'form': form,
-            'order': self.order,
             'articles': self.articles,
         }
         return render(request, 'login.html', context)
@@ -418,7 +516,6 @@ class RegistrationView(CartMixin, View):
 
         context = {
             'form': form,
-            'order': self.order,
             'page_role': 'registration',
             'articles': self.articles,
         }
@@ -456,7 +553,6 @@ class RegistrationView(CartMixin, View):
                       'Интроверт<noreply@as-electron.ru>', [user.email],
                       fail_silently=False, html_message=html)
             context = {
-                'order': self.order,
                 'articles': self.articles,
             }
 
@@ -464,7 +560,6 @@ class RegistrationView(CartMixin, View):
 
         context = {
             'form': form,
-            'order': self.order,
             'articles': self.articles,
         }
         return render(request, 'registration.html', context)
@@ -474,7 +569,6 @@ class EmailConfirmationView(CartMixin, View):
 
     def get(self, request, *args, **kwargs):
         context = {
-            'order': self.order,
             'page_role': 'registration',
             'articles': self.articles,
         }
@@ -517,7 +611,6 @@ class ArticleView(CartMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['order'] = self.order
         context['articles'] = self.articles
 
         return context
@@ -543,3 +636,72 @@ class EmailView(LoginRequiredMixin, CartMixin, View):
             )
         except Exception:
             return HttpResponse(status=404)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class StockUpdateView(View):
+    """
+    Stock counts from the POS: POST [{"id", "warehouse1", "warehouse2"}].
+    Updates are queued and written in batches by flush_stock_updates.
+    """
+
+    def post(self, request, *args, **kwargs):
+        token = request.headers.get('Authorization', '')
+        if not settings.POS_API_TOKEN or not hmac.compare_digest(
+                token, f'Token {settings.POS_API_TOKEN}'):
+            return JsonResponse({'error': 'forbidden'}, status=403)
+
+        try:
+            items = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({'error': 'invalid json'}, status=400)
+        if not isinstance(items, list):
+            return JsonResponse({'error': 'list expected'}, status=400)
+
+        updates, rejected = parse_stock_updates(items)
+        if updates and queue_stock_updates(updates):
+            flush_stock_updates.apply_async(countdown=STOCK_FLUSH_DELAY)
+
+        return JsonResponse({'accepted': len(updates), 'rejected': rejected})
+
+
+class MediaView(View):
+    """
+    /media for tor hidden services, normally nginx serves it. Derivatives
+    named by content hash are cached by browsers for a year.
+    """
+
+    def get(self, request, path):
+        response = serve(request, path, document_root=settings.MEDIA_ROOT)
+        if IMMUTABLE_NAME.match(path):
+            response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+
+class ImageVariantView(View):
+    """
+    /img/<hash>/<w>x<h>.<jpg|webp>: product image of a whitelisted size,
+    generated on the first request. Later requests are served by nginx
+    straight from MEDIA_ROOT/img/, see store.urls.
+    """
+
+    def get(self, request, image_hash, width, height, ext):
+        if (width, height) not in VARIANT_SIZES or ext not in VARIANT_FORMATS:
+            raise Http404
+        name = variant_name(image_hash, width, height, ext)
+        if not os.path.exists(media_path(name)):
+            stored = ProductImage.objects.filter(pk=image_hash).first()
+            if not stored:
+                raise Http404
+            if not get_variant(media_path(stored.name), name,
+                               (width, height), ext):
+                return HttpResponse(status=503)
+
+        if settings.DEBUG:
+            response = serve(request, name, document_root=settings.MEDIA_ROOT)
+        else:
+            response = HttpResponse(
+                content_type=f'image/{"jpeg" if ext == "jpg" else ext}')
+            response['X-Accel-Redirect'] = f'/media/{name}'
+        response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return response